@@ -1,3 +1,5 @@
 import wormgas.wormgas
 
-wormgas.wormgas.main()
+if __name__ == '__main__':
+    # reply worker processes are spawned, and re-import this script
+    wormgas.wormgas.main()
@@ -7,6 +7,9 @@ import random
 import time
 
 from .cobe import brain
+from .cobe import cache
+from .cobe import executor
+from .cobe import instrument
 from wormgas.util import to_bool
 from wormgas.wormgas import Wormgas
 
@@ -40,16 +43,54 @@ class ChatCog(cmds.Cog):
 
     def __init__(self, bot: Wormgas):
         self.bot = bot
+        self.config = bot.config.ns('chat')
+        self.state = bot.state.ns('chat')
         brain_file = bot.config.path.with_name('_brain.sqlite')
-        self.brain = brain.Brain(str(brain_file))
+        timeout = self.config.get_float('brain_timeout', 10)
+        adjacency_max_edges = self.config.get_int('adjacency_max_edges', 0)
+        reply_workers = self.config.get_int('reply_workers', 0)
+        # a compact brain exported from _brain.sqlite, shared by the reply workers
+        reply_snapshot = self.config.get('reply_snapshot')
+        # Reader connections let replies run while the brain is learning, but the adjacency cache is only kept in
+        # step with the learning connection, so replies use one or the other. An adjacency cache is only configured
+        # when it is wanted, so it wins unless chat:brain_readers is set too.
+        readers = self.config.get_int('brain_readers', 0 if adjacency_max_edges else 1)
+        options = brain.GraphOptions(
+            journal_mode=self.config.get('brain_journal_mode', 'wal'),
+            cache_size=self.config.get_int('brain_cache_size', 10000),
+            mmap_size=self.config.get_int('brain_mmap_size'),
+            wal_autocheckpoint=self.config.get_int('brain_checkpoint_pages', 1000)
+        )
+        # count and time the brain's SQL queries, for !brainstats
+        instrument_brain = self.config.get_bool('brain_instrument', False)
+        self.brain = executor.BrainExecutor(str(brain_file), timeout=timeout, adjacency_max_edges=adjacency_max_edges,
+                                            reply_workers=reply_workers, reply_snapshot=reply_snapshot,
+                                            readers=readers, options=options, instrument=instrument_brain)
+        self.learn_queue = executor.LearnQueue(self.brain,
+                                               max_size=self.config.get_int('learn_queue_size', 1000),
+                                               batch_size=self.config.get_int('learn_batch_size', 50),
+                                               batch_ms=self.config.get_int('learn_batch_ms', 1000))
+        self.learn_task = self.bot.loop.create_task(self.learn_queue.run())
+        # alternatives to repeated prompts, such as the revive message
+        self.reply_cache = cache.ReplyCache(ttl=self.config.get_int('reply_cache_ttl', 600),
+                                            alternatives=self.config.get_int('reply_cache_alternatives', 4),
+                                            max_learned=self.config.get_int('reply_cache_max_learned', 100))
+        # channel id -> semaphore that limits the replies being generated for the channel
+        self.reply_slots = {}
         self.revive_task = self.bot.loop.create_task(self.revive_chat())
 
+    def cog_unload(self):
+        self.revive_task.cancel()
+        self.learn_task.cancel()
+        self.learn_queue.flush()
+        self.brain.close()
+
     @cmds.command()
     @cmds.has_permissions(manage_channels=True)
     async def revive(self, ctx: cmds.Context, on_off: to_bool = None):
         """Turn chat revive on or off."""
         if isinstance(ctx.channel, discord.TextChannel):
-            revive_list = self.bot.config.get('chat:revive_channels', [])
+            revive_list = self.config.get('revive_channels', [])
             if ctx.channel.id in revive_list:
                 revive_list.remove(ctx.channel.id)
             if on_off:
@@ -57,23 +98,45 @@ class ChatCog(cmds.Cog):
                 await ctx.author.send(f'Chat revive is ON for {ctx.channel.mention}')
             else:
                 await ctx.author.send(f'Chat revive is OFF for {ctx.channel.mention}')
-            self.bot.config['chat:revive_channels'] = revive_list
+            self.config['revive_channels'] = revive_list
+
+    @cmds.command()
+    @cmds.is_owner()
+    async def brainstats(self, ctx: cmds.Context):
+        """Show timings and counts for the last reply and the last learned batch.
+
+        Set chat:brain_instrument to also count SQL queries and cache hits.
+        """
+        reply_stats = self.brain.last_reply_stats
+        learn_stats = self.learn_queue.last_batch_stats
+        queue = self.learn_queue.stats()
+        reply_cache = self.reply_cache.stats()
+        lines = [
+            f'Last reply: {instrument.summary(reply_stats) if reply_stats else "none yet"}',
+            f'Last learn: {instrument.summary(learn_stats) if learn_stats else "none yet"}',
+            f'Learn queue: {queue["depth"]} waiting ({queue["lag"]:.1f}s behind), {queue["learned"]} learned '
+            f'in {queue["batches"]} batches, {queue["dropped"]} dropped',
+            f'Reply cache: {reply_cache["size"]} prompts, {reply_cache["hits"]} hits, {reply_cache["misses"]} misses',
+            f'Brain calls pending: {self.brain.pending}'
+        ]
+        await ctx.author.send('\n'.join(lines))
 
     async def revive_chat(self):
         await self.bot.wait_until_ready()
         while not self.bot.is_closed():
             now = int(time.time())
-            for channel_id in self.bot.config.get('chat:revive_channels', []):
+            for channel_id in self.config.get('revive_channels', []):
                 channel = self.bot.get_channel(channel_id)
-                last = int(self.bot.config.get(f'chat:last_time_public_message:{channel.id}', 0))
-                wait = int(self.bot.config.get('chat:wait_revive', 3600))
+                last = self.state.get_int(f'last_time_public_message:{channel.id}', 0)
+                wait = self.config.get_int('wait_revive', 3600)
                 if last < now - wait:
                     log.info(f'Reviving chat in {channel.id} (#{channel.name})')
-                    last_message = self.bot.config.get('chat:last_message', '')
-                    response = await self.reply(last_message, learn=False)
+                    last_message = self.state.get('last_message', '')
+                    async with self.reply_slot(channel.id):
+                        response = await self.reply(last_message, learn=False, kind='revive')
                     await channel.send(response)
-                    self.bot.config[f'chat:last_time_respond:{channel.id}'] = now
-                    self.bot.config['chat:last_time_public_message:{channel.id}'] = now
+                    self.state[f'last_time_respond:{channel.id}'] = now
+                    self.state[f'last_time_public_message:{channel.id}'] = now
                 else:
                     remaining = last + wait - now
                     log.info(f'{channel.id} (#{channel.name}): will revive chat in {remaining} seconds')
@@ -93,15 +156,29 @@ class ChatCog(cmds.Cog):
 
         # Do not learn from messages from ignored users.
         learn = True
-        if message.author.id in self.bot.config.get('chat:ignore_users', []):
+        if message.author.id in self.config.get('ignore_users', []):
             log.info(f'{message.author.display_name} is in the chat:ignore_users list')
             learn = False
 
-        # Clean up message and generate response.
+        # Clean up message.
         text = message.clean_content
         text = text.replace(f'@{self.bot.user.display_name}', '')
+
+        # Only generate a response when it will be sent: in direct messages and when I am mentioned. Everything else is
+        # only learned.
+        if not message.guild:
+            kind = 'dm'
+        elif self.bot.user.id in [u.id for u in message.mentions]:
+            kind = 'mention'
+        else:
+            self.state[f'last_time_public_message:{message.channel.id}'] = int(time.time())
+            if not self.ignored(text):
+                self.remember(text, learn)
+            return
+
         log.info(f'Generating reply for {text!r}')
-        response = await self.reply(text, learn=learn)
+        async with self.reply_slot(message.channel.id):
+            response = await self.reply(text, learn=learn, kind=kind)
 
         # Always respond to direct messages, and record the time for public messages.
         now = int(time.time())
@@ -109,34 +186,70 @@ class ChatCog(cmds.Cog):
             await message.author.send(response)
             return
         else:
-            self.bot.config[f'chat:last_time_public_message:{message.channel.id}'] = now
+            self.state[f'last_time_public_message:{message.channel.id}'] = now
 
-        # If I was not mentioned, do not reply.
-        if self.bot.user.id not in [u.id for u in message.mentions]:
-            return
-
-        last = int(self.bot.config.get(f'chat:last_time_respond:{message.channel.id}', 0))
-        wait = int(self.bot.config.get('chat:wait_respond', 0))
+        last = self.state.get_int(f'last_time_respond:{message.channel.id}', 0)
+        wait = self.config.get_int('wait_respond', 0)
         if last < now - wait:
             await message.channel.send(f'{message.author.mention}: {response}')
-            self.bot.config[f'chat:last_time_respond:{message.channel.id}'] = now
+            self.state[f'last_time_respond:{message.channel.id}'] = now
         else:
             await message.author.send(response)
             remaining = last + wait - now
             m = f'I am cooling down. I cannot respond in {message.channel.mention} for another {remaining} seconds.'
             await message.author.send(m)
 
-    async def reply(self, text, learn=True):
-        ignore = self.bot.config.get('chat:ignore')
+    def reply_budget(self, kind):
+        """Build the reply budget for a kind of reply (dm, mention, public or revive) from the chat:budget:<kind>:*
+        settings, falling back to the chat:budget:* settings."""
+        limits = {}
+        budget = self.config.ns('budget')
+        for name in ('time_ms', 'max_candidates', 'max_duplicates', 'max_no_improvement'):
+            value = budget.get_int(f'{kind}:{name}', budget.get_int(name))
+            if value is not None:
+                limits[name] = value
+        return brain.ReplyBudget(**limits)
+
+    def reply_slot(self, channel_id):
+        """Limit the number of replies being generated at once for one channel to chat:reply_concurrency."""
+        slot = self.reply_slots.get(channel_id)
+        if slot is None:
+            slot = asyncio.Semaphore(self.config.get_int('reply_concurrency', 1))
+            self.reply_slots[channel_id] = slot
+        return slot
+
+    def ignored(self, text):
+        ignore = self.config.get('ignore')
         if ignore is not None and re.search(ignore, text, re.IGNORECASE):
             log.info(f'Ignoring {text!r}')
+            return True
+        return False
+
+    def remember(self, text, learn=True):
+        """Remember text as the last message, for chat revive, and queue it to be learned."""
+        self.state['last_message'] = text
+        if learn:
+            log.info(f'Learning {text!r}')
+            self.learn_queue.put(text)
+
+    async def reply(self, text, learn=True, kind='public'):
+        if self.ignored(text):
             return random.choice(self.quotes)
-        self.bot.config['chat:last_message'] = text
+        self.remember(text, learn)
         to_brain = text
-        if learn:
-            log.info(f'Learning {to_brain!r}')
-            self.brain.learn(to_brain)
-        return self.brain.reply(to_brain)
+        try:
+            response = self.reply_cache.get(to_brain, self.learn_queue.learned)
+            if response is None:
+                replies = await self.brain.replies(to_brain, self.reply_budget(kind),
+                                                   count=self.reply_cache.alternatives)
+                if not replies:
+                    return brain.Brain.NO_REPLY
+                response = replies[0]
+                self.reply_cache.put(to_brain, replies[1:], self.learn_queue.learned)
+            return response
+        except (asyncio.TimeoutError, brain.CobeError) as e:
+            log.warning(f'Brain did not reply to {to_brain!r}: {e!r}')
+            return random.choice(self.quotes)
 
 
 def setup(bot: Wormgas):
@@ -0,0 +1,298 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import pathlib
+import random
+import statistics
+import sqlite3
+import sys
+import time
+
+import stemming.porter2
+
+from . import bench
+from . import brain
+from . import compact
+from . import tokenizers
+
+
+def read_text(f):
+    for line in f:
+        line = line.strip()
+        if line:
+            yield line
+
+
+def read_jsonl(f, field):
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        text = json.loads(line).get(field)
+        if isinstance(text, str) and text.strip():
+            yield text.strip()
+
+
+def chunked(iterable, size):
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def open_lines(args):
+    if args.input == '-':
+        f = sys.stdin
+    else:
+        f = open(args.input, encoding='utf-8', errors='replace')
+
+    if args.format == 'jsonl' or (args.format is None and args.input.endswith('.jsonl')):
+        return f, read_jsonl(f, args.field)
+    return f, read_text(f)
+
+
+def learn(args):
+    """Learn a large text or JSONL corpus in batch mode."""
+    b = brain.Brain(args.brain)
+    f, lines = open_lines(args)
+
+    line_count = 0
+    token_count = 0
+    uncommitted = 0
+    start = last_report = time.time()
+
+    def report(final=False):
+        elapsed = max(time.time() - start, 1e-9)
+        end = '\n' if final else '\r'
+        print(f'{line_count} lines, {token_count} tokens in {elapsed:.1f}s: '
+              f'{line_count / elapsed:.0f} lines/s, {token_count / elapsed:.0f} tokens/s',
+              end=end, file=sys.stderr, flush=True)
+
+    b.start_batch_learning()
+    try:
+        for chunk in chunked(lines, args.chunk_size):
+            token_count += b.learn_batch(chunk)
+            line_count += len(chunk)
+            uncommitted += len(chunk)
+
+            if uncommitted >= args.commit_every:
+                b.commit_batch_learning()
+                uncommitted = 0
+
+            if time.time() - last_report >= args.progress:
+                report()
+                last_report = time.time()
+    finally:
+        # Committing recreates the reply indexes, which can take a while on
+        # a large brain.
+        print('\nCommitting and rebuilding indexes', file=sys.stderr)
+        b.stop_batch_learning()
+        if f is not sys.stdin:
+            f.close()
+
+    report(final=True)
+
+
+def export(args):
+    """Export a brain to the compact, memory-mapped format."""
+    start = time.time()
+    conn = sqlite3.connect(pathlib.Path(args.brain).resolve().as_uri() + '?mode=ro', uri=True)
+    try:
+        # write next to the output and rename, so readers never map a partial file
+        tmp = args.output + '.tmp'
+        compact.export(conn, tmp)
+        os.replace(tmp, args.output)
+    finally:
+        conn.close()
+
+    size = os.path.getsize(args.output)
+    print(f'Wrote {args.output} ({size / 2 ** 20:.1f} MiB) in {time.time() - start:.1f}s', file=sys.stderr)
+
+
+def sample_inputs(filename, count, seed=0):
+    """Pick count words from a brain to use as reply inputs."""
+    b = brain.Brain(filename, readonly=True)
+    try:
+        words = [row[0] for row in b.graph.cursor().execute('SELECT text FROM tokens WHERE is_word = 1 ORDER BY id')]
+    finally:
+        b.graph.close()
+    return random.Random(seed).sample(words, min(count, len(words)))
+
+
+def reply_latency(filename, inputs, candidates):
+    """Return the median and mean time in ms to reply to each of inputs,
+    generating a fixed number of candidates per reply."""
+    b = brain.Brain(filename, readonly=True, seed=0)
+    budget = brain.ReplyBudget(time_ms=60000, max_candidates=candidates)
+    times = []
+    try:
+        for text in inputs:
+            start = time.perf_counter()
+            b.reply(text, budget)
+            times.append((time.perf_counter() - start) * 1000)
+    finally:
+        b.graph.close()
+    return statistics.median(times), statistics.mean(times)
+
+
+def table_sizes(filename):
+    conn = sqlite3.connect(pathlib.Path(filename).resolve().as_uri() + '?mode=ro', uri=True)
+    try:
+        return {table: conn.execute(f'SELECT count(*) FROM {table}').fetchone()[0]
+                for table in ('tokens', 'token_stems', 'nodes', 'edges')}
+    finally:
+        conn.close()
+
+
+def prune(args):
+    """Prune rare edges and unused nodes and tokens, then vacuum the brain."""
+    inputs = sample_inputs(args.brain, args.samples)
+
+    def report(label):
+        sizes = table_sizes(args.brain)
+        median, mean = reply_latency(args.brain, inputs, args.candidates)
+        print(f'{label}: {os.path.getsize(args.brain) / 2 ** 20:.1f} MiB, '
+              + ', '.join(f'{count} {table}' for table, count in sizes.items())
+              + f'; reply latency median {median:.1f}ms, mean {mean:.1f}ms', file=sys.stderr)
+
+    report('Before')
+
+    b = brain.Brain(args.brain)
+    try:
+        start = time.time()
+        removed = b.prune(args.min_count)
+        print(f'Deleted {removed["edges"]} edges with count < {args.min_count}, '
+              f'{removed["dead_end_edges"]} dead-end edges, {removed["nodes"]} nodes, '
+              f'{removed["tokens"]} tokens and {removed["token_stems"]} stems in {time.time() - start:.1f}s',
+              file=sys.stderr)
+
+        start = time.time()
+        b.graph.vacuum()
+        print(f'Vacuumed and analyzed in {time.time() - start:.1f}s', file=sys.stderr)
+    finally:
+        b.graph.close()
+
+    report('After')
+
+
+def rate(func, items):
+    """Call func on each of items, and return the calls per second."""
+    start = time.perf_counter()
+    for item in items:
+        func(item)
+    return len(items) / max(time.perf_counter() - start, 1e-9)
+
+
+def tokenize(args):
+    """Measure tokenizer and stemmer throughput on a corpus."""
+    f, lines = open_lines(args)
+    lines = list(itertools.islice(lines, args.limit))
+    if f is not sys.stdin:
+        f.close()
+
+    tokenizer = tokenizers.CobeTokenizer()
+    tokens = [token for line in lines for token in tokenizer.split(line)]
+    words = [token for token in tokens if brain.WORD_RE.search(token)]
+    print(f'{len(lines)} lines, {len(tokens)} tokens, {len(words)} words, {len(set(words))} distinct words',
+          file=sys.stderr)
+
+    for name, split in (('Cobe', tokenizer.split), ('MegaHAL', tokenizers.MegaHALTokenizer.split)):
+        start = time.perf_counter()
+        count = sum(len(split(line)) for line in lines)
+        print(f'{name} tokenizer: {count / (time.perf_counter() - start):.0f} tokens/s', file=sys.stderr)
+
+    print(f'porter2 stemmer, uncached: {rate(stemming.porter2.stem, words):.0f} words/s', file=sys.stderr)
+    stemmer = tokenizers.CobeStemmer()
+    print(f'CobeStemmer, cold cache: {rate(stemmer.stem, words):.0f} words/s', file=sys.stderr)
+    print(f'CobeStemmer, warm cache: {rate(stemmer.stem, words):.0f} words/s', file=sys.stderr)
+
+
+def benchmark(args):
+    """Benchmark learning and replying on a fresh brain, and write the results as JSON."""
+    if args.corpus is None:
+        messages = list(bench.synthetic_corpus(args.messages, args.vocabulary, args.seed))
+    else:
+        f, lines = open_lines(argparse.Namespace(input=args.corpus, format=args.format, field=args.field))
+        messages = list(itertools.islice(lines, args.messages))
+        if f is not sys.stdin:
+            f.close()
+
+    budget = brain.ReplyBudget(time_ms=args.time_ms, max_candidates=args.max_candidates)
+    results = bench.run(messages, args.replies, budget, args.batch_size, args.adjacency, seed=args.seed)
+    results['corpus'] = args.corpus or f'synthetic, {args.vocabulary} words'
+
+    learn, reply = results['learn'], results['reply']
+    latency = reply['latency_ms']
+    print(f'Learned {learn["messages"]} messages at {learn["messages_per_second"]:.0f} messages/s; '
+          f'reply latency p50 {latency["p50"]:.1f}ms, p95 {latency["p95"]:.1f}ms, p99 {latency["p99"]:.1f}ms; '
+          f'{reply["candidates_per_reply"]:.0f} candidates and {reply["queries_per_reply"]:.0f} queries per reply; '
+          f'peak RSS {results["peak_rss_bytes"] / 2 ** 20:.0f} MiB', file=sys.stderr)
+
+    if args.output == '-':
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m wormgas.cogs.cobe', description='Maintain a cobe brain.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('learn', help=learn.__doc__, description=learn.__doc__)
+    p.add_argument('brain', help='path to the brain, which is created if it does not exist')
+    p.add_argument('input', help='text file with one message per line, JSONL file, or - for stdin')
+    p.add_argument('--format', choices=('text', 'jsonl'), help='input format (default: from the file extension)')
+    p.add_argument('--field', default='content', help='JSONL field holding the message text (default: %(default)s)')
+    p.add_argument('--chunk-size', type=int, default=500, help='lines learned per batch (default: %(default)s)')
+    p.add_argument('--commit-every', type=int, default=100000, help='lines between commits (default: %(default)s)')
+    p.add_argument('--progress', type=float, default=5.0, help='seconds between progress lines (default: %(default)s)')
+    p.set_defaults(func=learn)
+
+    p = subparsers.add_parser('tokenize', help=tokenize.__doc__, description=tokenize.__doc__)
+    p.add_argument('input', help='text file with one message per line, JSONL file, or - for stdin')
+    p.add_argument('--format', choices=('text', 'jsonl'), help='input format (default: from the file extension)')
+    p.add_argument('--field', default='content', help='JSONL field holding the message text (default: %(default)s)')
+    p.add_argument('--limit', type=int, default=100000, help='lines to read (default: %(default)s)')
+    p.set_defaults(func=tokenize)
+
+    p = subparsers.add_parser('bench', help=benchmark.__doc__, description=benchmark.__doc__)
+    p.add_argument('--corpus', help='text or JSONL corpus to learn (default: a synthetic corpus)')
+    p.add_argument('--format', choices=('text', 'jsonl'), help='corpus format (default: from the file extension)')
+    p.add_argument('--field', default='content', help='JSONL field holding the message text (default: %(default)s)')
+    p.add_argument('--messages', type=int, default=20000, help='messages to learn (default: %(default)s)')
+    p.add_argument('--vocabulary', type=int, default=5000, help='words in the synthetic corpus (default: %(default)s)')
+    p.add_argument('--batch-size', type=int, default=50, help='messages learned per commit (default: %(default)s)')
+    p.add_argument('--replies', type=int, default=200, help='replies to time (default: %(default)s)')
+    p.add_argument('--time-ms', type=int, default=200, help='time budget per reply (default: %(default)s)')
+    p.add_argument('--max-candidates', type=int, help='candidate budget per reply (default: no limit)')
+    p.add_argument('--adjacency', action='store_true', help='load the adjacency cache before replying')
+    p.add_argument('--seed', type=int, default=0, help='random seed (default: %(default)s)')
+    p.add_argument('--output', default='-', help='file to write JSON results to, or - for stdout (default: %(default)s)')
+    p.set_defaults(func=benchmark)
+
+    p = subparsers.add_parser('export', help=export.__doc__, description=export.__doc__)
+    p.add_argument('brain', help='path to the brain')
+    p.add_argument('output', help='path to the compact brain to write')
+    p.set_defaults(func=export)
+
+    p = subparsers.add_parser('prune', help=prune.__doc__, description=prune.__doc__)
+    p.add_argument('brain', help='path to the brain')
+    p.add_argument('--min-count', type=int, default=2, help='delete edges seen fewer times (default: %(default)s)')
+    p.add_argument('--samples', type=int, default=50, help='replies timed before and after (default: %(default)s)')
+    p.add_argument('--candidates', type=int, default=100,
+                   help='reply candidates generated per timed reply (default: %(default)s)')
+    p.set_defaults(func=prune)
+
+    args = parser.parse_args()
+    logging.basicConfig(level='INFO', format='%(levelname)s [%(name)s] %(message)s', stream=sys.stderr)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
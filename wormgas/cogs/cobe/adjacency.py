@@ -0,0 +1,225 @@
+import array
+import bisect
+import itertools
+import random
+import sys
+
+from . import cache
+
+# Node and edge ids, and edge counts, are stored as 32-bit integers.
+TYPECODE = 'i'
+
+
+def _zeros(n):
+    return array.array(TYPECODE, itertools.repeat(0, n))
+
+
+def _cumulative(weights):
+    return array.array('q', itertools.accumulate(weights))
+
+
+class Adjacency:
+    """An in-memory copy of the edges table, used for random walks.
+
+    Edge attributes are stored in flat arrays indexed by edge id. The edges
+    leaving each node are stored CSR-style: one array of edge ids sorted by
+    node, and an array of offsets into it indexed by node id. There is one
+    such index for each direction. Edges learned after loading go into small
+    per-node overflow arrays.
+
+    Walk steps and pivot nodes are chosen in proportion to edge and node
+    counts, using cumulative count tables that are built on first use and
+    dropped whenever one of their counts changes."""
+
+    TABLE_CACHE_SIZE = 100000
+
+    def __init__(self, max_edges=None, rng=None):
+        self.max_edges = max_edges
+        self.random = rng or random.Random()
+        self.edge_count = 0
+
+        self.prev = array.array(TYPECODE)
+        self.next = array.array(TYPECODE)
+        self.count = array.array(TYPECODE)
+        self.has_space = bytearray()
+
+        # forward is indexed by prev node, backward by next node
+        self.forward_offsets = _zeros(1)
+        self.forward_edges = array.array(TYPECODE)
+        self.backward_offsets = _zeros(1)
+        self.backward_edges = array.array(TYPECODE)
+
+        self.forward_extra = {}
+        self.backward_extra = {}
+
+        # node id -> first token id and count, first token id -> node ids
+        self.node_token = array.array(TYPECODE)
+        self.node_count = array.array(TYPECODE)
+        self.token_nodes = {}
+
+        # (direction, node id) -> edge ids and cumulative edge counts
+        self.edge_tables = cache.LRUCache(self.TABLE_CACHE_SIZE)
+        # token id -> node ids and cumulative node counts
+        self.pivot_tables = cache.LRUCache(self.TABLE_CACHE_SIZE)
+
+    @classmethod
+    def load(cls, conn, max_edges=None, rng=None):
+        """Load the edges table from conn. Returns None if the table holds
+        more than max_edges edges. Random choices come from rng, a
+        random.Random."""
+        edge_count, max_edge_id = conn.execute('SELECT count(*), max(id) FROM edges').fetchone()
+        if max_edges is not None and edge_count > max_edges:
+            return None
+
+        max_node_id = conn.execute('SELECT max(id) FROM nodes').fetchone()[0] or 0
+
+        adj = cls(max_edges, rng)
+        adj._grow(max_edge_id or 0)
+        adj._grow_nodes(max_node_id)
+
+        q = 'SELECT id, prev_node, next_node, has_space, count FROM edges'
+        for edge_id, prev, nxt, has_space, count in conn.execute(q):
+            adj.prev[edge_id] = prev
+            adj.next[edge_id] = nxt
+            adj.has_space[edge_id] = has_space
+            adj.count[edge_id] = count
+        adj.edge_count = edge_count
+
+        adj.forward_offsets, adj.forward_edges = adj._index(adj.prev, max_node_id)
+        adj.backward_offsets, adj.backward_edges = adj._index(adj.next, max_node_id)
+
+        for node_id, token_id, count in conn.execute('SELECT id, token0_id, count FROM nodes'):
+            adj._set_node(node_id, token_id, count)
+
+        return adj
+
+    def _index(self, nodes, max_node_id):
+        # Counting sort of the edge ids by node. An edge id with node 0 is
+        # a gap in the edges table.
+        offsets = _zeros(max_node_id + 2)
+        for node in nodes:
+            offsets[node + 1] += 1
+        offsets[1] = 0
+
+        for i in range(1, len(offsets)):
+            offsets[i] += offsets[i - 1]
+
+        edges = _zeros(offsets[-1])
+        fill = array.array(TYPECODE, offsets)
+        for edge_id, node in enumerate(nodes):
+            if node:
+                edges[fill[node]] = edge_id
+                fill[node] += 1
+
+        return offsets, edges
+
+    def _grow(self, edge_id):
+        missing = edge_id + 1 - len(self.count)
+        if missing > 0:
+            self.prev.extend(itertools.repeat(0, missing))
+            self.next.extend(itertools.repeat(0, missing))
+            self.count.extend(itertools.repeat(0, missing))
+            self.has_space.extend(bytes(missing))
+
+    def _grow_nodes(self, node_id):
+        missing = node_id + 1 - len(self.node_count)
+        if missing > 0:
+            self.node_token.extend(itertools.repeat(0, missing))
+            self.node_count.extend(itertools.repeat(0, missing))
+
+    def _set_node(self, node_id, token_id, count):
+        self.node_token[node_id] = token_id
+        self.node_count[node_id] = count
+
+        if token_id not in self.token_nodes:
+            self.token_nodes[token_id] = array.array(TYPECODE)
+        self.token_nodes[token_id].append(node_id)
+
+    def add_node(self, node_id, token_id):
+        """Record a new node."""
+        self._grow_nodes(node_id)
+        self._set_node(node_id, token_id, 0)
+        self.pivot_tables.pop(token_id)
+
+    def add_edge(self, edge_id, prev, nxt, has_space, count=1):
+        """Record a new edge."""
+        self._grow(edge_id)
+        self.prev[edge_id] = prev
+        self.next[edge_id] = nxt
+        self.has_space[edge_id] = has_space
+
+        for extra, node in ((self.forward_extra, prev), (self.backward_extra, nxt)):
+            if node not in extra:
+                extra[node] = array.array(TYPECODE)
+            extra[node].append(edge_id)
+
+        self.edge_count += 1
+        self.increment(edge_id, count)
+
+    def increment(self, edge_id, count=1):
+        self.count[edge_id] += count
+
+        # this is what the edges triggers do to the nodes table
+        nxt = self.next[edge_id]
+        self.node_count[nxt] += count
+
+        self.edge_tables.pop((1, self.prev[edge_id]))
+        self.edge_tables.pop((0, nxt))
+        self.pivot_tables.pop(self.node_token[nxt])
+
+    def _edges(self, node, direction):
+        if direction:
+            offsets, edges, extra = self.forward_offsets, self.forward_edges, self.forward_extra
+        else:
+            offsets, edges, extra = self.backward_offsets, self.backward_edges, self.backward_extra
+
+        if node + 1 < len(offsets):
+            start, end = offsets[node], offsets[node + 1]
+        else:
+            start = end = 0
+
+        return edges, start, end, extra.get(node, ())
+
+    def _choose(self, items, cumulative):
+        if len(cumulative) == 0 or cumulative[-1] == 0:
+            return None
+        i = bisect.bisect_right(cumulative, self.random.randrange(cumulative[-1]))
+        return items[i]
+
+    def random_edge(self, node, direction):
+        """Return a random edge id leaving node, in the forward direction if
+        direction is true or the backward direction otherwise. Edges are
+        weighted by their counts."""
+        key = (direction, node)
+        table = self.edge_tables.get(key)
+        if table is None:
+            edges, start, end, extra = self._edges(node, direction)
+            edge_ids = edges[start:end] + array.array(TYPECODE, extra)
+            table = edge_ids, _cumulative(self.count[edge_id] for edge_id in edge_ids)
+            self.edge_tables[key] = table
+
+        return self._choose(*table)
+
+    def random_node_with_token(self, token_id):
+        """Return a random node whose first token is token_id, weighted by
+        node counts."""
+        table = self.pivot_tables.get(token_id)
+        if table is None:
+            node_ids = self.token_nodes.get(token_id, array.array(TYPECODE))
+            table = node_ids, _cumulative(self.node_count[node_id] for node_id in node_ids)
+            self.pivot_tables[token_id] = table
+
+        return self._choose(*table)
+
+    def memory_usage(self):
+        """Return the approximate number of bytes used by the cache."""
+        size = sum(sys.getsizeof(a) for a in (
+            self.prev, self.next, self.count, self.has_space,
+            self.forward_offsets, self.forward_edges, self.backward_offsets, self.backward_edges,
+            self.node_token, self.node_count))
+        for d in (self.forward_extra, self.backward_extra, self.token_nodes):
+            size += sys.getsizeof(d)
+            size += sum(sys.getsizeof(key) + sys.getsizeof(ids) for key, ids in d.items())
+        for tables in (self.edge_tables, self.pivot_tables):
+            size += sum(sys.getsizeof(ids) + sys.getsizeof(cumulative) for ids, cumulative in tables.values())
+        return size
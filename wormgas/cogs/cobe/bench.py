@@ -0,0 +1,163 @@
+import itertools
+import os
+import platform
+import random
+import resource
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from . import brain
+
+# parts of synthetic words
+ONSETS = ['b', 'br', 'c', 'ch', 'd', 'f', 'g', 'gr', 'h', 'j', 'k', 'l', 'm', 'n', 'p', 'qu', 'r', 's', 'sh', 'st',
+          't', 'th', 'tr', 'v', 'w', 'z']
+VOWELS = ['a', 'e', 'i', 'o', 'u', 'ai', 'ea', 'ee', 'oo', 'ou']
+CODAS = ['', '', 'd', 'g', 'k', 'l', 'm', 'n', 'ng', 'r', 's', 't', 'x']
+ENDINGS = ['.', '.', '!', '?', '', '', ' :)', '...']
+
+
+def synthetic_corpus(messages, vocabulary=5000, seed=0):
+    """Generate messages of made-up words, with word frequencies that follow
+    Zipf's law like real chat. The same arguments always give the same
+    messages."""
+    rng = random.Random(seed)
+
+    words = set()
+    while len(words) < vocabulary:
+        syllables = rng.choice((1, 1, 2, 2, 3))
+        words.add(''.join(rng.choice(ONSETS) + rng.choice(VOWELS) + rng.choice(CODAS) for _ in range(syllables)))
+    words = sorted(words)
+    rng.shuffle(words)
+    weights = list(itertools.accumulate(1 / rank for rank in range(1, len(words) + 1)))
+
+    for _ in range(messages):
+        length = max(1, int(rng.lognormvariate(2, 0.6)))
+        message = ' '.join(rng.choices(words, cum_weights=weights, k=length))
+        if rng.random() < 0.3:
+            message = message.capitalize()
+        yield message + rng.choice(ENDINGS)
+
+
+def percentile(values, p):
+    """The p-th percentile of values, by the nearest-rank method."""
+    values = sorted(values)
+    if not values:
+        return None
+    return values[max(0, min(len(values) - 1, round(p / 100 * len(values) + 0.5) - 1))]
+
+
+def peak_rss():
+    """Return the peak resident set size of this process in bytes."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and KiB elsewhere
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def git_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip()
+
+
+def bench_learn(b, messages, batch_size):
+    """Learn messages in batches of batch_size, committing each batch the
+    way the chat cog's learn queue does."""
+    start = time.perf_counter()
+    tokens = 0
+    for i in range(0, len(messages), batch_size):
+        tokens += b.learn_batch(messages[i:i + batch_size])
+    elapsed = time.perf_counter() - start
+
+    return {
+        'messages': len(messages),
+        'tokens': tokens,
+        'seconds': elapsed,
+        'messages_per_second': len(messages) / elapsed,
+        'tokens_per_second': tokens / elapsed,
+    }
+
+
+def bench_reply(b, inputs, budget):
+    """Reply to each of inputs within budget, and summarize the latency,
+    candidates and SQL queries per reply."""
+    queries = [0]
+    b.graph.trace(lambda statement: queries.__setitem__(0, queries[0] + 1))
+
+    latencies = []
+    candidates = []
+    query_counts = []
+    stop_reasons = {}
+    try:
+        for text in inputs:
+            queries[0] = 0
+            start = time.perf_counter()
+            b.reply(text, budget)
+            latencies.append((time.perf_counter() - start) * 1000)
+            query_counts.append(queries[0])
+
+            stats = b.last_reply_stats or {}
+            candidates.append(stats.get('candidates', 0))
+            reason = stats.get('stop_reason')
+            stop_reasons[reason] = stop_reasons.get(reason, 0) + 1
+    finally:
+        b.graph.trace(None)
+
+    return {
+        'replies': len(inputs),
+        'budget': {'time_ms': budget.time_ms, 'max_candidates': budget.max_candidates,
+                   'max_duplicates': budget.max_duplicates, 'max_no_improvement': budget.max_no_improvement},
+        'latency_ms': {
+            'mean': statistics.mean(latencies),
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'max': max(latencies),
+        },
+        'candidates_per_reply': statistics.mean(candidates),
+        'queries_per_reply': statistics.mean(query_counts),
+        'stop_reasons': stop_reasons,
+    }
+
+
+def run(messages, replies=200, budget=None, batch_size=50, adjacency=False, filename=None, seed=0):
+    """Build a brain from messages and benchmark learning and replying.
+    Returns the results as a dict that can be written as JSON. The brain is
+    built in a temporary directory unless filename is given."""
+    if budget is None:
+        budget = brain.ReplyBudget()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if filename is None:
+            filename = os.path.join(tmp, 'bench.sqlite')
+        b = brain.Brain(filename, seed=seed)
+        try:
+            learn = bench_learn(b, messages, batch_size)
+
+            if adjacency:
+                b.graph.load_adjacency()
+
+            inputs = random.Random(seed).sample(messages, min(replies, len(messages)))
+            reply = bench_reply(b, inputs, budget)
+        finally:
+            b.graph.close()
+        size = os.path.getsize(filename)
+
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'seed': seed,
+        'adjacency': adjacency,
+        'brain_bytes': size,
+        'learn': learn,
+        'reply': reply,
+        'peak_rss_bytes': peak_rss(),
+    }
@@ -1,17 +1,34 @@
 # Copyright (C) 2011 Peter Teichman
 # Edited 2015-02-11 for simplicity and Python 3 compatibility by William Jackson
 
+import bisect
 import collections
+import heapq
+import itertools
+import logging
 import os
+import pathlib
 import pprint
 import random
 import re
 import sqlite3
 import time
 
+from concurrent.futures.process import BrokenProcessPool
+
+from . import adjacency
+from . import cache
+from . import compact
+from . import instrument
+from . import parallel
 from . import scoring
 from . import tokenizers
 
+log = logging.getLogger(__name__)
+
+# tokens containing a word character are words
+WORD_RE = re.compile(r'\w', re.UNICODE)
+
 
 class CobeError(Exception):
     pass
@@ -27,14 +44,37 @@ class Brain:
     # in the tokens table
     SPACE_TOKEN_ID = -1
 
-    def __init__(self, filename):
+    # number of reply candidates scored together
+    SCORE_BATCH_SIZE = 64
+
+    # the classic MegaHAL reply, for a brain that doesn't know any words yet
+    NO_REPLY = 'I don\'t know enough to answer you yet!'
+
+    def __init__(self, filename, readonly=False, options=None, seed=None):
         """Construct a brain for the specified filename. If that file
         doesn't exist, it will be initialized with the default brain
-        settings."""
-        if not os.path.exists(filename):
-            Brain.init(filename)
+        settings. A readonly brain opens an existing file with a read-only
+        connection, and can reply but not learn. A compact brain (see
+        compact.export) is always read-only. options is a GraphOptions.
+
+        All random choices made while replying come from self.random, which
+        is seeded with seed. Replies that are limited by a candidate budget
+        rather than time are repeatable for the same seed and brain."""
+        self.filename = filename
+        self.random = random.Random(seed)
+
+        if compact.is_compact(filename):
+            graph = compact.CompactGraph(filename, rng=self.random)
+        elif readonly:
+            uri = pathlib.Path(filename).resolve().as_uri() + '?mode=ro'
+            graph = Graph(sqlite3.connect(uri, uri=True, isolation_level=None), run_migrations=False,
+                          options=options, readonly=True, rng=self.random)
+        else:
+            if not os.path.exists(filename):
+                Brain.init(filename)
+            graph = Graph(sqlite3.connect(filename, isolation_level=None), options=options, rng=self.random)
 
-        self.graph = graph = Graph(sqlite3.connect(filename, isolation_level=None))
+        self.graph = graph
 
         version = graph.get_info_text('version')
         if version != '2':
@@ -61,6 +101,37 @@ class Brain:
         self._end_context_id = graph.get_node_by_tokens(self._end_context)
 
         self._learning = False
+        self._reply_pool = None
+
+        # With instrument set, replies and learning also count and time
+        # their SQL queries and record cache hit rates.
+        self.instrument = False
+
+        # timings and counts of the last reply and the last learn (see
+        # instrument.summary)
+        self.last_reply_stats = None
+        self.last_learn_stats = None
+
+    def start_reply_workers(self, workers, filename=None):
+        """Generate and score replies in worker processes, each with its
+        own read-only connection to this brain. If filename is given, the
+        workers reply from that brain instead, e.g. a compact snapshot of
+        this one whose pages are shared by all of the workers."""
+        self.stop_reply_workers()
+        try:
+            self._reply_pool = parallel.ReplyPool(filename or self.filename, workers)
+        except Exception:
+            log.exception('Could not start reply workers, replying in this process')
+
+    def share_reply_workers(self, other):
+        """Use the reply workers started by another Brain on the same
+        file. The other Brain stops them."""
+        self._reply_pool = other._reply_pool
+
+    def stop_reply_workers(self):
+        if self._reply_pool is not None:
+            self._reply_pool.close()
+            self._reply_pool = None
 
     def start_batch_learning(self):
         """Begin a series of batch learn operations. Data will not be
@@ -68,15 +139,25 @@ class Brain:
         called. Learn text using the normal learn(text) method."""
         self._learning = True
 
-        self.graph.cursor().execute('PRAGMA journal_mode=memory')
+        # WAL mode can't be left while readers are connected, and doesn't
+        # need to be: it only syncs the log at checkpoints.
+        if self.graph.options.journal_mode != 'wal':
+            self.graph.cursor().execute('PRAGMA journal_mode=memory')
         self.graph.drop_reply_indexes()
+        self.graph.begin()
+
+    def commit_batch_learning(self):
+        """Commit what has been batch learned so far, and keep batch
+        learning."""
+        self.graph.commit()
+        self.graph.begin()
 
     def stop_batch_learning(self):
         """Finish a series of batch learn operations."""
         self._learning = False
 
         self.graph.commit()
-        self.graph.cursor().execute('PRAGMA journal_mode=truncate')
+        self.graph.set_journal_mode()
         self.graph.ensure_indexes()
 
     def del_stemmer(self):
@@ -88,7 +169,8 @@ class Brain:
         self.graph.commit()
 
     def set_stemmer(self, language):
-        self.stemmer = tokenizers.CobeStemmer()
+        if self.stemmer is None:
+            self.stemmer = tokenizers.CobeStemmer()
 
         self.graph.delete_token_stems()
         self.graph.update_token_stems(self.stemmer)
@@ -96,11 +178,55 @@ class Brain:
         self.graph.set_info_text('stemmer', language)
         self.graph.commit()
 
+    def prune(self, min_count):
+        """Delete edges seen fewer than min_count times, then the nodes,
+        tokens and stems that are no longer used. Returns a dict of the
+        number of rows deleted from each table."""
+        removed = self.graph.prune_edges(min_count, self._end_context_id)
+        removed.update(self.graph.collect_garbage(self._end_context_id))
+        self.graph.commit()
+        return removed
+
     def learn(self, text):
         """Learn a string of text."""
-        tokens = self.tokenizer.split(text)
-
-        self._learn_tokens(tokens)
+        self.learn_batch([text])
+
+    def learn_batch(self, texts):
+        """Learn a sequence of strings of text in a single transaction.
+        Returns the number of tokens learned."""
+        start = time.perf_counter()
+        recorder = self._start_recording()
+        phases = {}
+        try:
+            token_lists = [self.tokenizer.split(text) for text in texts]
+            phases['tokenize'] = (time.perf_counter() - start) * 1000
+            count = self._learn_token_lists(token_lists, phases)
+        finally:
+            if recorder is not None:
+                recorder.stop()
+
+        stats = {'ms': (time.perf_counter() - start) * 1000, 'phases_ms': phases, 'messages': len(texts),
+                 'tokens': count}
+        if recorder is not None:
+            recorder.add_to(stats)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('Learned: ' + instrument.summary(stats))
+        self.last_learn_stats = stats
+
+        return count
+
+    def _start_recording(self):
+        if not self.instrument:
+            return None
+        return instrument.Recorder(self.graph, self.cache_stats)
+
+    def cache_stats(self):
+        """Return the size, hits and misses of the graph's lookup caches
+        and the stemmer's cache."""
+        stats = self.graph.cache_stats()
+        if self.stemmer is not None:
+            stats['stems'] = self.stemmer.cache.stats()
+        return stats
 
     def _to_edges(self, tokens):
         """This is an iterator that returns the nodes of our graph:
@@ -144,43 +270,140 @@ with its two nodes"""
             prev = context
 
     def _learn_tokens(self, tokens):
-        token_count = len([token for token in tokens if token != " "])
-        if token_count < 3:
-            return
+        return self._learn_token_lists([tokens])
 
-        # create each of the non-whitespace tokens
-        token_ids = []
-        for text in tokens:
-            if text == ' ':
-                token_ids.append(self.SPACE_TOKEN_ID)
-                continue
-
-            token_id = self.graph.get_token_by_text(text, create=True,
-                                                    stemmer=self.stemmer)
-            token_ids.append(token_id)
+    def _learn_token_lists(self, token_lists, phases=None):
+        # phases, if given, gets the milliseconds spent in each step
+        if phases is None:
+            phases = {}
 
-        edges = list(self._to_edges(token_ids))
+        token_lists = [tokens for tokens in token_lists
+                       if len([token for token in tokens if token != " "]) >= 3]
+        if len(token_lists) == 0:
+            return 0
 
-        prev_id = None
-        for prev, has_space, nxt in self._to_graph(edges):
-            if prev_id is None:
-                prev_id = self.graph.get_node_by_tokens(prev)
-            next_id = self.graph.get_node_by_tokens(nxt)
-
-            self.graph.add_edge(prev_id, next_id, has_space)
-            prev_id = next_id
+        self.graph.begin()
+        try:
+            # create each of the non-whitespace tokens
+            start = time.perf_counter()
+            texts = {text for tokens in token_lists for text in tokens if text != ' '}
+            token_ids = self.graph.get_tokens_by_text(texts, create=True, stemmer=self.stemmer)
+            phases['tokens'] = (time.perf_counter() - start) * 1000
+
+            start = time.perf_counter()
+            chains = []
+            for tokens in token_lists:
+                ids = [self.SPACE_TOKEN_ID if text == ' ' else token_ids[text] for text in tokens]
+                chains.append(list(self._to_graph(self._to_edges(ids))))
+
+            contexts = {context for chain in chains for prev, _, nxt in chain for context in (prev, nxt)}
+            node_ids = self.graph.get_nodes_by_tokens(contexts)
+            phases['nodes'] = (time.perf_counter() - start) * 1000
+
+            start = time.perf_counter()
+            self.graph.add_edges((node_ids[prev], node_ids[nxt], has_space)
+                                 for chain in chains for prev, has_space, nxt in chain)
+            phases['edges'] = (time.perf_counter() - start) * 1000
+        except Exception:
+            if not self._learning:
+                self.graph.rollback()
+            raise
 
         if not self._learning:
+            start = time.perf_counter()
             self.graph.commit()
+            phases['commit'] = (time.perf_counter() - start) * 1000
+
+        return sum(1 for tokens in token_lists for token in tokens if token != ' ')
+
+    def reply(self, text, budget=None):
+        """Reply to a string of text. The search for a reply is limited
+        by budget, a ReplyBudget (default: half a second)."""
+        replies = self.replies(text, budget)
+        if not replies:
+            # we couldn't find any pivot words in _babble(), so we're
+            # working with an essentially empty brain. Use the classic
+            # MegaHAL reply:
+            return self.NO_REPLY
 
-    def reply(self, text):
-        """Reply to a string of text."""
+        return replies[0]
+
+    def replies(self, text, budget=None, count=1):
+        """Reply to a string of text with up to count different replies,
+        best first. The replies all come from one search, limited by
+        budget. Returns an empty list if no reply could be generated."""
+        if budget is None:
+            budget = ReplyBudget()
+        start = time.perf_counter()
+        end = time.time() + budget.time_ms / 1000
+
+        texts = []
+
+        recorder = self._start_recording()
+        try:
+            if self._reply_pool is not None:
+                try:
+                    texts, stats = self._reply_pool.reply(text, end, budget, count)
+                except BrokenProcessPool:
+                    log.exception('Reply workers failed, replying in this process')
+                    self._reply_pool = None
+                    # the workers may have used up the reply window
+                    end = time.time() + budget.time_ms / 1000
+
+            if self._reply_pool is None:
+                scored, stats = self.best_replies(text, end, budget, count)
+                texts = list(dict.fromkeys(self.reply_texts([reply for _, reply in scored], stats)))
+        finally:
+            if recorder is not None:
+                recorder.stop()
+
+        stats['ms'] = (time.perf_counter() - start) * 1000
+        if recorder is not None:
+            recorder.add_to(stats)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('Replied: ' + instrument.summary(stats))
+        self.last_reply_stats = stats
+
+        return texts
+
+    def reply_texts(self, replies, stats):
+        """Look up the words of a list of Replies, and add the time it took
+        to the phases in stats."""
+        start = time.perf_counter()
+        texts = [reply.to_text() for reply in replies]
+        stats['phases_ms']['to_text'] = (time.perf_counter() - start) * 1000
+        return texts
+
+    def best_reply(self, text, end, budget=None):
+        """Generate and score replies to a string of text until the time
+        end, or until the budget's other limits are reached. Returns the
+        best score, the best Reply (or None if no reply could be
+        generated), and a dict of stats that says why the search stopped
+        and how long each phase of it took."""
+        replies, stats = self.best_replies(text, end, budget)
+        if not replies:
+            return -1.0, None, stats
+
+        best_score, best_reply = replies[0]
+        return best_score, best_reply, stats
+
+    def best_replies(self, text, end, budget=None, count=1):
+        """Like best_reply, but keep the count best Replies. Returns a list
+        of (score, Reply), best first, and the stats."""
+        if budget is None:
+            budget = ReplyBudget()
+        start = time.perf_counter()
+
+        # drop cached counts if another connection has learned since the
+        # last reply
+        self.graph.check_data_version()
 
         tokens = self.tokenizer.split(text)
-        input_ids = map(self.graph.get_token_by_text, tokens)
+        token_ids = self.graph.get_tokens_by_text(tokens)
+        input_ids = [token_ids.get(token) for token in tokens]
 
         # filter out unknown words and non-words from the potential pivots
-        pivot_set = self._filter_pivots(input_ids)
+        pivot_set = self._filter_pivots(token_ids.values())
 
         # Conflate the known ids with the stems of their words
         if self.stemmer is not None:
@@ -191,54 +414,98 @@ with its two nodes"""
         if len(pivot_set) == 0:
             pivot_set = self._babble()
 
+        pivots_time = time.perf_counter() - start
+        generate_time = 0.0
+        score_time = 0.0
+
         score_cache = {}
+        candidates = []
 
         best_score = -1.0
-        best_reply = None
+        # the best count replies as a heap of (score, order found, Reply)
+        best_replies = []
 
-        # loop for half a second
-        start = time.time()
-        end = start + 0.5
-        count = 0
+        generated = 0
+        scored = 0
+        duplicates = 0
+        duplicates_in_row = 0
+        since_improvement = 0
 
-        while time.time() < end:
+        stop_reason = None
+        if len(pivot_set) == 0:
+            stop_reason = 'no pivots'
+
+        while True:
+            if stop_reason is None:
+                if time.time() >= end:
+                    stop_reason = 'time'
+                elif budget.max_candidates is not None and generated >= budget.max_candidates:
+                    stop_reason = 'candidates'
+                elif budget.max_duplicates is not None and duplicates_in_row >= budget.max_duplicates:
+                    stop_reason = 'duplicates'
+                elif budget.max_no_improvement is not None and since_improvement >= budget.max_no_improvement:
+                    stop_reason = 'no improvement'
+
+            # score new candidates in batches
+            if len(candidates) >= self.SCORE_BATCH_SIZE or (stop_reason and len(candidates) > 0):
+                start = time.perf_counter()
+                scores = self.scorer.score_batch(candidates)
+                for reply, score in zip(candidates, scores):
+                    score_cache[self._get_reply_key(reply)] = score
+
+                    if len(best_replies) < count:
+                        heapq.heappush(best_replies, (score, -scored, reply))
+                    elif score > best_replies[0][0]:
+                        heapq.heapreplace(best_replies, (score, -scored, reply))
+                    scored += 1
+
+                    if score > best_score:
+                        best_score = score
+                        since_improvement = 0
+                    else:
+                        since_improvement += 1
+                candidates = []
+                score_time += time.perf_counter() - start
+
+            if stop_reason is not None:
+                break
+
+            start = time.perf_counter()
             candidate = self._generate_reply(pivot_set)
+            generate_time += time.perf_counter() - start
 
             if candidate is None:
                 continue
 
-            count += 1
+            generated += 1
             edges, pivot_node = candidate
             reply = Reply(self.graph, tokens, input_ids, pivot_node, edges)
 
             key = self._get_reply_key(reply)
-            if key not in score_cache:
-                score = self.scorer.score(reply)
-                score_cache[key] = score
-            else:
+            if key in score_cache:
                 # skip scoring, we've already seen this reply
-                score = -1
-
-            if score > best_score:
-                best_reply = reply
-                best_score = score
+                duplicates += 1
+                duplicates_in_row += 1
+                continue
 
-        if best_reply is None:
-            # we couldn't find any pivot words in _babble(), so we're
-            # working with an essentially empty brain. Use the classic
-            # MegaHAL reply:
-            return 'I don\'t know enough to answer you yet!'
+            duplicates_in_row = 0
+            score_cache[key] = None
+            candidates.append(reply)
 
         self.scorer.end()
 
-        # look up the words for these tokens
-        text = best_reply.to_text()
+        stats = {'stop_reason': stop_reason, 'candidates': generated, 'scored': scored, 'duplicates': duplicates,
+                 'phases_ms': {'pivots': pivots_time * 1000, 'generate': generate_time * 1000,
+                               'score': score_time * 1000}}
 
-        return text
+        return [(score, reply) for score, _, reply in sorted(best_replies, reverse=True)], stats
 
     def _conflate_stems(self, pivot_set, tokens):
+        stems = {token: self.stemmer.stem(token) for token in set(tokens)}
+        token_ids = self.graph.get_tokens_by_stems(stems.values())
+
         for token in tokens:
-            stem_ids = self.graph.get_token_stem_id(self.stemmer.stem(token))
+            stem_ids = token_ids[stems[token]]
             if len(stem_ids) == 0:
                 continue
 
@@ -269,21 +536,20 @@ with its two nodes"""
 
     def _filter_pivots(self, pivots):
         # remove pivots that might not give good results
-        tokens = set(filter(None, pivots))
+        is_word = self.graph.get_word_flags(filter(None, pivots))
 
-        filtered = self.graph.get_word_tokens(tokens)
+        filtered = {token_id for token_id, word in is_word.items() if word}
         if len(filtered) == 0:
-            filtered = self.graph.get_tokens(tokens)
+            filtered = set(is_word)
 
-        return set(filtered)
+        return filtered
 
-    @staticmethod
-    def _choose_pivot(pivot_ids):
-        pivot = random.choice(tuple(pivot_ids))
+    def _choose_pivot(self, pivot_ids):
+        pivot = self.random.choice(tuple(pivot_ids))
 
         if isinstance(pivot, tuple):
             # the input word was stemmed to several things
-            pivot = random.choice(pivot)
+            pivot = self.random.choice(pivot)
 
         return pivot
 
@@ -324,6 +590,53 @@ tokenizer -- One of Cobe, MegaHAL (default Cobe). See documentation
         graph.init(order, tokenizer)
 
 
+class ReplyBudget:
+    """Limits on the search for a reply. The search stops after time_ms
+    milliseconds, after max_candidates candidates, after max_duplicates
+    candidates in a row that were already seen, or after max_no_improvement
+    scored candidates in a row that didn't beat the best one so far. A limit
+    of None is ignored."""
+    def __init__(self, time_ms=500, max_candidates=None, max_duplicates=None, max_no_improvement=None):
+        self.time_ms = time_ms
+        self.max_candidates = max_candidates
+        self.max_duplicates = max_duplicates
+        self.max_no_improvement = max_no_improvement
+
+    def __repr__(self):
+        return 'ReplyBudget(time_ms={}, max_candidates={}, max_duplicates={}, max_no_improvement={})'.format(
+            self.time_ms, self.max_candidates, self.max_duplicates, self.max_no_improvement)
+
+    def split(self, n):
+        """Return the budget for each of n searches running in parallel."""
+        max_candidates = self.max_candidates
+        if max_candidates is not None:
+            max_candidates = -(-max_candidates // n)
+        return ReplyBudget(self.time_ms, max_candidates, self.max_duplicates, self.max_no_improvement)
+
+
+class GraphOptions:
+    """Settings for a Graph's sqlite connection. journal_mode is one of
+    sqlite's journal modes; in 'wal' mode, readers on other connections
+    don't wait for the writer, and the log is checkpointed into the
+    database every wal_autocheckpoint pages. cache_size is in pages (or
+    KiB if negative), and mmap_size is the number of bytes of the database
+    to memory-map (None leaves sqlite's default)."""
+
+    JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+
+    def __init__(self, journal_mode='truncate', cache_size=10000, mmap_size=None, wal_autocheckpoint=1000):
+        if journal_mode not in self.JOURNAL_MODES:
+            raise CobeError('unknown journal mode {}'.format(journal_mode))
+        self.journal_mode = journal_mode
+        self.cache_size = int(cache_size)
+        self.mmap_size = None if mmap_size is None else int(mmap_size)
+        self.wal_autocheckpoint = int(wal_autocheckpoint)
+
+    def __repr__(self):
+        return 'GraphOptions(journal_mode={!r}, cache_size={}, mmap_size={}, wal_autocheckpoint={})'.format(
+            self.journal_mode, self.cache_size, self.mmap_size, self.wal_autocheckpoint)
+
+
 class Reply:
     """Provide useful support for scoring functions"""
     def __init__(self, graph, tokens, token_ids, pivot_node, edges):
@@ -341,9 +654,11 @@ class Reply:
         return pprint.pformat(text)
 
     def to_text(self):
+        words = self.graph.get_words_by_nodes(edge.prev for edge in self.edges)
+
         text = []
         for edge in self.edges:
-            text.append(edge.get_prev_word())
+            text.append(words[edge.prev])
             if edge.has_space:
                 text.append(' ')
         return ''.join(text)
@@ -376,16 +691,61 @@ class Edge:
 
 class Graph:
     """A special-purpose graph class, stored in a sqlite3 database"""
-    def __init__(self, conn, run_migrations=True):
+
+    # Older sqlite builds allow at most 999 parameters per query.
+    MAX_PARAMS = 999
+
+    TOKEN_CACHE_SIZE = 100000
+    NODE_CACHE_SIZE = 100000
+    NODE_COUNT_CACHE_SIZE = 100000
+    STEM_CACHE_SIZE = 100000
+    EDGE_TABLE_CACHE_SIZE = 10000
+
+    # 2**i - 1 for each bit of an ordinal, for walking the Fenwick tree in
+    # token_nodes.subtotal (see _maybe_create_pivot_tables)
+    FENWICK_MASKS = 'VALUES ' + ', '.join('({})'.format((1 << i) - 1) for i in range(32))
+
+    def __init__(self, conn, run_migrations=True, options=None, readonly=False, rng=None):
+        # _conn is swapped for an instrument.TimedConnection while queries
+        # are being recorded
+        self._db = conn
         self._conn = conn
+        self.options = options or GraphOptions()
+        self.random = rng or random.Random()
         conn.row_factory = sqlite3.Row
 
+        self._adjacency = None
+
+        self._data_version = None
+
+        # token text -> token id, token id tuple -> node id
+        self._token_ids = cache.LRUCache(self.TOKEN_CACHE_SIZE)
+        self._node_ids = cache.LRUCache(self.NODE_CACHE_SIZE)
+
+        # These last across replies. Learning changes node counts, so
+        # add_edges drops the counts of the nodes it touches.
+        self._node_counts = cache.LRUCache(self.NODE_COUNT_CACHE_SIZE)
+        self._node_tokens = cache.LRUCache(self.NODE_CACHE_SIZE)
+        self._token_texts = cache.LRUCache(self.TOKEN_CACHE_SIZE)
+
+        # token id -> is_word, stem -> tuple of token ids
+        self._token_words = cache.LRUCache(self.TOKEN_CACHE_SIZE)
+        self._stem_tokens = cache.LRUCache(self.STEM_CACHE_SIZE)
+
+        # (direction, node id) -> edge rows, cumulative edge counts and the
+        # data_version they were read at, for random walks. add_edges drops
+        # the tables of the nodes it touches.
+        self._edge_tables = cache.LRUCache(self.EDGE_TABLE_CACHE_SIZE)
+
         if self.is_initted():
             if run_migrations:
                 self._run_migrations()
 
             self.order = int(self.get_info_text('order'))
 
+            # read-only connections can't create these for older brains
+            self._has_pivot_tables = self._has_column('token_nodes', 'subtotal') and self._has_table('word_tokens')
+
             self._all_tokens = ','.join(['token%d_id' % i
                                          for i in range(self.order)])
             self._all_tokens_args = ' AND '.join(
@@ -395,23 +755,137 @@ class Graph:
 
             # Use a 10M cache by default. This speeds replies quite a bit.
             c = self.cursor()
-            c.execute('PRAGMA cache_size=10000')
-
-            # Each of these speed-for-reliability trade-offs is useful for
-            # bulk learning.
-            c.execute('PRAGMA journal_mode=truncate')
+            c.execute('PRAGMA cache_size=%d' % self.options.cache_size)
+            if self.options.mmap_size is not None:
+                c.execute('PRAGMA mmap_size=%d' % self.options.mmap_size)
             c.execute('PRAGMA temp_store=memory')
-            c.execute('PRAGMA synchronous=OFF')
+
+            if not readonly:
+                # Each of these speed-for-reliability trade-offs is useful
+                # for bulk learning.
+                self.set_journal_mode()
+                c.execute('PRAGMA synchronous=OFF')
+
+    def set_journal_mode(self):
+        """Switch to the journal mode in this graph's options."""
+        c = self.cursor()
+        c.execute('PRAGMA journal_mode=%s' % self.options.journal_mode)
+        if self.options.journal_mode == 'wal':
+            c.execute('PRAGMA wal_autocheckpoint=%d' % self.options.wal_autocheckpoint)
 
     def cursor(self):
         return self._conn.cursor()
 
+    def load_adjacency(self, max_edges=None):
+        """Load the edges table into memory so random walks and pivot
+        node selection don't need to query sqlite, and are weighted by edge
+        and node counts. The cache is not loaded (or is dropped later) if
+        the brain holds more than max_edges edges."""
+        start = time.time()
+        self._adjacency = adjacency.Adjacency.load(self._conn, max_edges, self.random)
+        if self._adjacency is None:
+            log.warning('Not loading adjacency cache: brain has more than {} edges'.format(max_edges))
+            return False
+
+        log.info('Loaded {} edges into adjacency cache in {:.2f}s, using {:.1f} MiB'.format(
+            self._adjacency.edge_count, time.time() - start, self._adjacency.memory_usage() / 2 ** 20))
+        return True
+
+    def unload_adjacency(self):
+        self._adjacency = None
+
+    def adjacency_memory_usage(self):
+        """Return the approximate size in bytes of the adjacency cache."""
+        if self._adjacency is None:
+            return 0
+        return self._adjacency.memory_usage()
+
+    def begin(self):
+        if not self._conn.in_transaction:
+            self._conn.execute('BEGIN')
+
     def commit(self):
         self._conn.commit()
 
+    def rollback(self):
+        self._conn.rollback()
+
+        # ids created in the transaction are gone
+        self.clear_caches()
+        if self._adjacency is not None:
+            log.warning('Dropping adjacency cache after rollback')
+            self._adjacency = None
+
     def close(self):
         return self._conn.close()
 
+    def trace(self, callback):
+        """Call callback with the text of each SQL statement this graph
+        runs, or stop tracing if callback is None."""
+        self._conn.set_trace_callback(callback)
+
+    def start_query_stats(self):
+        """Count and time the SQL statements this graph runs until
+        stop_query_stats is called. Returns the instrument.QueryStats."""
+        stats = instrument.QueryStats()
+        self._conn = instrument.TimedConnection(self._db, stats)
+        return stats
+
+    def stop_query_stats(self):
+        self._conn = self._db
+
+    def check_data_version(self):
+        """Drop the cached lookups that learning can change if another
+        connection has committed changes since the last check."""
+        data_version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+        if self._data_version is not None and data_version != self._data_version:
+            # Learning only adds tokens, nodes and edges: the ids, texts
+            # and word flags already cached stay valid (only prune, which
+            # runs with the bot stopped, deletes rows). Node counts grow,
+            # and new tokens join the token lists of their stems.
+            self._node_counts.clear()
+            self._stem_tokens.clear()
+        self._data_version = data_version
+
+    def clear_caches(self):
+        for lru in self._caches().values():
+            lru.clear()
+
+    def _caches(self):
+        return {
+            'token_ids': self._token_ids,
+            'node_ids': self._node_ids,
+            'node_counts': self._node_counts,
+            'node_tokens': self._node_tokens,
+            'token_texts': self._token_texts,
+            'token_words': self._token_words,
+            'stem_tokens': self._stem_tokens,
+            'edge_tables': self._edge_tables,
+        }
+
+    def cache_stats(self):
+        """Return the size, hits and misses of each lookup cache."""
+        return {name: lru.stats() for name, lru in self._caches().items()}
+
+    def _cached_lookup(self, lru, keys, q):
+        # Look up keys in an LRU cache, and fetch the rest with the query q,
+        # which selects (key, value) rows for the keys in an IN ({}) clause.
+        result = {}
+        missing = []
+        for key in set(keys):
+            value = lru.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                result[key] = value
+
+        for chunk in self._chunks(missing):
+            for key, value in self._conn.execute(q.format(','.join('?' * len(chunk))), chunk):
+                lru[key] = value
+                result[key] = value
+
+        return result
+
     def is_initted(self):
         try:
             self.get_info_text('order')
@@ -464,88 +938,180 @@ class Graph:
         return str(tuple(seq))
 
     def get_token_by_text(self, text, create=False, stemmer=None):
-        c = self.cursor()
+        return self.get_tokens_by_text([text], create, stemmer).get(text)
+
+    def _chunks(self, seq, width=1):
+        # split seq into lists small enough to pass as query parameters
+        seq = list(seq)
+        size = self.MAX_PARAMS // width
+        for i in range(0, len(seq), size):
+            yield seq[i:i + size]
+
+    def get_tokens_by_text(self, texts, create=False, stemmer=None):
+        """Return a dict of token text -> token id for texts. If create is
+        true, missing tokens are inserted; otherwise they are left out."""
+        result = {}
+        missing = []
+        for text in set(texts):
+            token_id = self._token_ids.get(text)
+            if token_id is None:
+                missing.append(text)
+            else:
+                result[text] = token_id
 
-        q = 'SELECT id FROM tokens WHERE text = ?'
+        if len(missing) == 0:
+            return result
 
-        row = c.execute(q, (text,)).fetchone()
-        if row:
-            return row[0]
-        elif create:
-            q = 'INSERT INTO tokens (text, is_word) VALUES (?, ?)'
+        found = self._select_tokens(missing)
 
-            is_word = bool(re.search('\w', text, re.UNICODE))
-            c.execute(q, (text, is_word))
+        if create and len(found) < len(missing):
+            new = [text for text in missing if text not in found]
+            rows = [(text, WORD_RE.search(text) is not None) for text in new]
+            self._conn.executemany('INSERT INTO tokens (text, is_word) VALUES (?, ?)', rows)
+            created = self._select_tokens(new)
+            found.update(created)
 
-            token_id = c.lastrowid
-            if is_word and stemmer is not None:
-                self.insert_stem(token_id, stemmer.stem(text))
+            if stemmer is not None:
+                self.insert_stems((created[text], stemmer.stem(text)) for text, is_word in rows if is_word)
 
-            return token_id
+        for text, token_id in found.items():
+            self._token_ids[text] = token_id
 
-    def insert_stem(self, token_id, stem):
+        result.update(found)
+        return result
+
+    def _select_tokens(self, texts):
+        found = {}
+        for chunk in self._chunks(texts):
+            q = 'SELECT id, text, is_word FROM tokens WHERE text IN ({})'.format(','.join('?' * len(chunk)))
+            for token_id, text, is_word in self._conn.execute(q, chunk):
+                found[text] = token_id
+                self._token_words[token_id] = is_word
+        return found
+
+    def insert_stems(self, rows):
+        rows = list(rows)
         q = 'INSERT INTO token_stems (token_id, stem) VALUES (?, ?)'
-        self._conn.execute(q, (token_id, stem))
+        self._conn.executemany(q, rows)
+        for _, stem in rows:
+            self._stem_tokens.pop(stem)
+
+    def insert_stem(self, token_id, stem):
+        self.insert_stems([(token_id, stem)])
 
     def get_token_by_id(self, token_id):
-        q = 'SELECT text FROM tokens WHERE id = ?'
-        row = self._conn.execute(q, (token_id,)).fetchone()
-        if row:
-            return row[0]
+        return self.get_token_texts([token_id]).get(token_id)
+
+    def get_token_texts(self, token_ids):
+        """Return a dict of token id -> token text."""
+        return self._cached_lookup(self._token_texts, token_ids, 'SELECT id, text FROM tokens WHERE id IN ({})')
 
     def get_token_stem_id(self, stem):
-        q = 'SELECT token_id FROM token_stems WHERE token_stems.stem = ?'
-        rows = self._conn.execute(q, (stem,))
-        if rows:
-            return tuple(val[0] for val in rows)
+        return self.get_tokens_by_stems([stem])[stem]
+
+    def get_tokens_by_stems(self, stems):
+        """Return a dict of stem -> tuple of the ids of tokens with that
+        stem, which is empty for unknown stems."""
+        result = {}
+        missing = []
+        for stem in set(stems):
+            token_ids = self._stem_tokens.get(stem)
+            if token_ids is None:
+                missing.append(stem)
+            else:
+                result[stem] = token_ids
+
+        found = collections.defaultdict(list)
+        for chunk in self._chunks(missing):
+            q = 'SELECT stem, token_id FROM token_stems WHERE stem IN ({})'.format(','.join('?' * len(chunk)))
+            for stem, token_id in self._conn.execute(q, chunk):
+                found[stem].append(token_id)
+
+        for stem in missing:
+            token_ids = tuple(found.get(stem, ()))
+            self._stem_tokens[stem] = token_ids
+            result[stem] = token_ids
+
+        return result
 
     def get_word_by_node(self, node_id):
         # return the last word in the node
-        q = 'SELECT tokens.text FROM nodes, tokens WHERE nodes.id = ? AND %s = tokens.id' % self._last_token
+        return self.get_words_by_nodes([node_id]).get(node_id)
 
-        row = self._conn.execute(q, (node_id,)).fetchone()
-        if row:
-            return row[0]
+    def get_words_by_nodes(self, node_ids):
+        """Return a dict of node id -> text of the last token in the node."""
+        node_tokens = self.get_tokens_by_nodes(node_ids)
+        texts = self.get_token_texts(node_tokens.values())
+        return {node_id: texts[token_id] for node_id, token_id in node_tokens.items()}
 
     def get_token_by_node(self, node_id):
         # return the last token in the node
-        q = 'SELECT tokens.id FROM nodes, tokens WHERE nodes.id = ? AND %s = tokens.id' % self._last_token
+        return self.get_tokens_by_nodes([node_id]).get(node_id)
 
-        row = self._conn.execute(q, (node_id,)).fetchone()
-        if row:
-            return row[0]
+    def get_tokens_by_nodes(self, node_ids):
+        """Return a dict of node id -> last token id in the node."""
+        q = 'SELECT id, %s FROM nodes WHERE id IN ({})' % self._last_token
+        return self._cached_lookup(self._node_tokens, node_ids, q)
+
+    def get_word_flags(self, token_ids):
+        """Return a dict of token id -> whether the token is a word, for
+        the token ids that exist."""
+        return self._cached_lookup(self._token_words, token_ids, 'SELECT id, is_word FROM tokens WHERE id IN ({})')
 
     def get_word_tokens(self, token_ids):
-        q = 'SELECT id FROM tokens WHERE id IN %s AND is_word = 1' % self.get_seq_expr(token_ids)
+        return [token_id for token_id, is_word in self.get_word_flags(token_ids).items() if is_word]
 
-        rows = self._conn.execute(q)
-        if rows:
-            return [row['id'] for row in rows]
+    def get_tokens(self, token_ids):
+        return list(self.get_word_flags(token_ids))
 
-        return []
+    def get_node_by_tokens(self, tokens):
+        tokens = tuple(tokens)
+        return self.get_nodes_by_tokens([tokens])[tokens]
+
+    def get_nodes_by_tokens(self, token_tuples):
+        """Return a dict of token id tuple -> node id, creating any nodes
+        that don't exist yet."""
+        result = {}
+        missing = []
+        for tokens in set(token_tuples):
+            node_id = self._node_ids.get(tokens)
+            if node_id is None:
+                missing.append(tokens)
+            else:
+                result[tokens] = node_id
 
-    def get_tokens(self, token_ids):
-        q = 'SELECT id FROM tokens WHERE id IN %s' % self.get_seq_expr(token_ids)
+        if len(missing) == 0:
+            return result
 
-        rows = self._conn.execute(q)
-        if rows:
-            return [row['id'] for row in rows]
+        found = self._select_nodes(missing)
 
-        return []
+        if len(found) < len(missing):
+            new = [tokens for tokens in missing if tokens not in found]
+            q = 'INSERT INTO nodes (count, %s) VALUES (0, %s)' % (self._all_tokens, self._all_tokens_q)
+            self._conn.executemany(q, new)
+            created = self._select_nodes(new)
+            found.update(created)
 
-    def get_node_by_tokens(self, tokens):
-        c = self.cursor()
+            if self._adjacency is not None:
+                for tokens, node_id in created.items():
+                    self._adjacency.add_node(node_id, tokens[0])
 
-        q = 'SELECT id FROM nodes WHERE %s' % self._all_tokens_args
+        for tokens, node_id in found.items():
+            self._node_ids[tokens] = node_id
 
-        row = c.execute(q, tokens).fetchone()
-        if row:
-            return int(row[0])
+        result.update(found)
+        return result
 
-        # if not found, create the node
-        q = 'INSERT INTO nodes (count, %s) VALUES (0, %s)' % (self._all_tokens, self._all_tokens_q)
-        c.execute(q, tokens)
-        return c.lastrowid
+    def _select_nodes(self, token_tuples):
+        found = {}
+        for chunk in self._chunks(token_tuples, self.order):
+            values = ','.join(['(%s)' % self._all_tokens_q] * len(chunk))
+            q = 'WITH v(%s) AS (VALUES %s) SELECT nodes.id, %s FROM v CROSS JOIN nodes USING (%s)' % (
+                self._all_tokens, values, self._all_tokens, self._all_tokens)
+            args = [token_id for tokens in chunk for token_id in tokens]
+            for row in self._conn.execute(q, args):
+                found[tuple(row[1:])] = row[0]
+        return found
 
     def get_node_tokens(self, node_id):
         q = 'SELECT %s FROM nodes WHERE id = ?' % self._all_tokens
@@ -559,81 +1125,214 @@ class Graph:
         tokens = self.get_node_tokens(node_id)
         return [self.get_token_by_id(token_id) for token_id in tokens]
 
-    def get_random_token(self):
-        # token 1 is the end_token_id, so we want to generate a random token
-        # id from 2..max(id) inclusive.
-        q = 'SELECT (abs(random()) % (MAX(id)-1)) + 2 FROM tokens'
-        row = self._conn.execute(q).fetchone()
+    def _random_row(self, count_q, q, args):
+        # Pick a random row of q, given a query that counts its rows. Both
+        # take args, and q also takes the row's offset or ordinal.
+        count = self._conn.execute(count_q, args).fetchone()[0]
+        if not count:
+            return None
+
+        row = self._conn.execute(q, args + (self.random.randrange(count),)).fetchone()
         if row:
             return row[0]
 
+    def _choose(self, items, cumulative):
+        # Pick one of items, weighted by their counts, given the running
+        # totals of those counts, as the adjacency cache does.
+        if len(cumulative) == 0 or cumulative[-1] == 0:
+            return None
+        return items[bisect.bisect_right(cumulative, self.random.randrange(cumulative[-1]))]
+
+    def _weighted_row(self, total_q, q, args):
+        # Pick a random row of q, weighted by count, given a query that sums
+        # the counts. Both take args, and q also takes a number below the
+        # total and returns the first row whose running total is greater.
+        total = self._conn.execute(total_q, args).fetchone()[0]
+        if not total:
+            return None
+
+        row = self._conn.execute(q, args + (self.random.randrange(total),)).fetchone()
+        if row:
+            return row[0]
+
+    def get_random_token(self):
+        """Return a random word token id, or None if there are none."""
+        if not self._has_pivot_tables:
+            return self._random_row('SELECT count(*) FROM tokens WHERE is_word = 1',
+                                    'SELECT id FROM tokens WHERE is_word = 1 LIMIT 1 OFFSET ?', ())
+
+        # ordinals are dense, so max(ordinal) + 1 is the number of rows
+        return self._random_row('SELECT max(ordinal) + 1 FROM word_tokens',
+                                'SELECT token_id FROM word_tokens WHERE ordinal = ?', ())
+
     def get_random_node_with_token(self, token_id):
-        c = self.cursor()
+        """Return a random node whose first token is token_id, weighted by
+        node counts, or None if there are none."""
+        if self._adjacency is not None:
+            return self._adjacency.random_node_with_token(token_id)
+
+        if not self._has_pivot_tables:
+            return self._weighted_row('SELECT sum(count) FROM nodes WHERE token0_id = ?',
+                                      'SELECT id FROM (SELECT id, sum(count) OVER (ORDER BY id) AS cumulative '
+                                      'FROM nodes WHERE token0_id = ?) WHERE cumulative > ? LIMIT 1', (token_id,))
+
+        # ordinals are dense, so max(ordinal) + 1 is the number of rows
+        n = self._conn.execute('SELECT max(ordinal) + 1 FROM token_nodes WHERE token_id = ?',
+                               (token_id,)).fetchone()[0]
+        if not n:
+            return None
+
+        # The total is the sum of the subtotals at n - 1 and at the ordinals
+        # below the ranges they cover, and the pick descends the tree from
+        # its top, so both take O(log n) primary key lookups.
+        path = []
+        i = n
+        while i:
+            path.append(i - 1)
+            i &= i - 1
+        q = 'SELECT sum(subtotal) FROM token_nodes WHERE token_id = ? AND ordinal IN ({})'
+        total = self._conn.execute(q.format(', '.join('?' * len(path))), [token_id] + path).fetchone()[0]
+        if not total:
+            return None
 
         q = '''
-            SELECT id FROM nodes WHERE token0_id = ? LIMIT 1
-            OFFSET abs(random())%(SELECT count(*) FROM nodes WHERE token0_id = ?)
+            WITH RECURSIVE descent(pos, rest, step) AS (
+                SELECT 0, ?2, ?3
+                UNION ALL
+                SELECT CASE WHEN subtotal <= rest THEN pos + step ELSE pos END,
+                       CASE WHEN subtotal <= rest THEN rest - subtotal ELSE rest END,
+                       step / 2
+                FROM descent LEFT JOIN token_nodes ON token_id = ?1 AND ordinal = pos + step - 1
+                WHERE step > 0)
+            SELECT node_id FROM token_nodes WHERE token_id = ?1 AND
+            ordinal = (SELECT pos FROM descent WHERE step = 0)
         '''
-
-        row = c.execute(q, (token_id, token_id)).fetchone()
+        row = self._conn.execute(q, (token_id, self.random.randrange(total), 1 << (n.bit_length() - 1))).fetchone()
         if row:
-            return int(row[0])
+            return row[0]
 
     def add_edge(self, prev_node, next_node, has_space):
-        c = self.cursor()
-
         assert isinstance(has_space, bool)
 
-        update_q = 'UPDATE edges SET count = count + 1 WHERE prev_node = ? AND next_node = ? AND has_space = ?'
+        self.add_edges([(prev_node, next_node, has_space)])
 
-        q = 'INSERT INTO edges (prev_node, next_node, has_space, count) VALUES (?, ?, ?, 1)'
+    def add_edges(self, edges):
+        """Add one to the count of each (prev_node, next_node, has_space)
+        edge, creating edges that don't exist yet."""
+        counts = collections.Counter(edges)
+        if len(counts) == 0:
+            return
 
-        args = (prev_node, next_node, has_space)
+        found = self._select_edges(counts)
 
-        c.execute(update_q, args)
-        if c.rowcount == 0:
-            c.execute(q, args)
+        self._conn.executemany('UPDATE edges SET count = count + ? WHERE id = ?',
+                               [(counts[edge], edge_id) for edge, edge_id in found.items()])
+
+        new = [edge for edge in counts if edge not in found]
+        q = 'INSERT INTO edges (prev_node, next_node, has_space, count) VALUES (?, ?, ?, ?)'
+        self._conn.executemany(q, [edge + (counts[edge],) for edge in new])
 
         # The count on the next_node in the nodes table must be
         # incremented here, to register that the node has been seen an
         # additional time. This is now handled by database triggers.
+        for prev_node, next_node, _ in counts:
+            self._node_counts.pop(next_node)
+            self._edge_tables.pop((1, prev_node))
+            self._edge_tables.pop((0, next_node))
+
+        adj = self._adjacency
+        if adj is not None:
+            for edge, edge_id in found.items():
+                adj.increment(edge_id, counts[edge])
+
+            if len(new) > 0:
+                if adj.max_edges is not None and adj.edge_count + len(new) > adj.max_edges:
+                    log.warning('Dropping adjacency cache: brain has more than {} edges'.format(adj.max_edges))
+                    self._adjacency = None
+                else:
+                    for edge, edge_id in self._select_edges(new).items():
+                        adj.add_edge(edge_id, *edge, count=counts[edge])
+
+    def _select_edges(self, edges):
+        found = {}
+        for chunk in self._chunks(edges, 3):
+            values = ','.join(['(?, ?, ?)'] * len(chunk))
+            q = 'WITH v(prev_node, next_node, has_space) AS (VALUES %s) ' \
+                'SELECT edges.id, prev_node, next_node, has_space ' \
+                'FROM v CROSS JOIN edges USING (prev_node, next_node, has_space)' % values
+            args = [arg for edge in chunk for arg in edge]
+            for edge_id, prev_node, next_node, has_space in self._conn.execute(q, args):
+                found[(prev_node, next_node, bool(has_space))] = edge_id
+        return found
 
     def get_node_count(self, node_id):
-        q = 'SELECT count FROM nodes WHERE nodes.id = ?'
+        return self.get_node_counts([node_id])[node_id]
 
-        row = self._conn.execute(q, (node_id,)).fetchone()
-        assert row
+    def get_node_counts(self, node_ids):
+        """Return a dict of node id -> node count."""
+        return self._cached_lookup(self._node_counts, node_ids, 'SELECT id, count FROM nodes WHERE id IN ({})')
 
-        return row[0]
+    def walk(self, node, end_id, direction, append):
+        """Perform a random walk on the graph starting at node. Edges are
+        weighted by their counts."""
+        if self._adjacency is not None:
+            return self._walk_adjacency(node, end_id, direction, append)
 
-    def get_node_counts(self, node_ids):
-        q = 'SELECT id, count FROM nodes WHERE id IN %s' % self.get_seq_expr(node_ids)
+        last_node = node
+
+        while last_node != end_id:
+            edge_id, prev, nxt, has_space, count = self._choose(*self._edge_table(last_node, direction))
 
-        return self._conn.execute(q)
+            append(Edge(self, edge_id, prev, nxt, has_space, count))
 
-    def walk(self, node, end_id, direction, append):
-        """Perform a random walk on the graph starting at node"""
+            if direction:
+                last_node = nxt
+            else:
+                last_node = prev
+
+    def _edge_table(self, node, direction):
+        # The edges leaving node and their cumulative counts, like
+        # Adjacency.random_edge's tables.
         if direction:
-            q = 'SELECT id, next_node, prev_node, has_space, count ' \
-                'FROM edges WHERE prev_node = :last ' \
-                'LIMIT 1 OFFSET abs(random())%(SELECT count(*) from edges ' \
-                '                              WHERE prev_node = :last)'
+            column = 'prev_node'
         else:
-            q = 'SELECT id, prev_node, next_node, has_space, count ' \
-                'FROM edges WHERE next_node = :last ' \
-                'LIMIT 1 OFFSET abs(random())%(SELECT count(*) from edges ' \
-                '                              WHERE next_node = :last)'
-
-        c = self.cursor()
+            column = 'next_node'
+
+        key = (direction, node)
+        table = self._edge_tables.get(key)
+        if table is not None:
+            rows, cumulative, data_version = table
+            if data_version == self._data_version:
+                return rows, cumulative
+
+            # Another connection has learned since the table was read.
+            # Between prunes edge counts only grow, so the table is still
+            # current if the node's total hasn't changed.
+            q = 'SELECT sum(count) FROM edges WHERE {} = ?'.format(column)
+            if cumulative and self._conn.execute(q, (node,)).fetchone()[0] == cumulative[-1]:
+                self._edge_tables[key] = rows, cumulative, self._data_version
+                return rows, cumulative
+
+        q = 'SELECT id, prev_node, next_node, has_space, count FROM edges WHERE {} = ?'.format(column)
+        rows = [tuple(row) for row in self._conn.execute(q, (node,))]
+        cumulative = list(itertools.accumulate(row[4] for row in rows))
+        self._edge_tables[key] = rows, cumulative, self._data_version
+        return rows, cumulative
+
+    def _walk_adjacency(self, node, end_id, direction, append):
+        adj = self._adjacency
         last_node = node
 
         while last_node != end_id:
-            row = c.execute(q, {'last': last_node}).fetchone()
+            edge_id = adj.random_edge(last_node, direction)
+            prev, nxt = adj.prev[edge_id], adj.next[edge_id]
 
-            append(Edge(self, row['id'], row['prev_node'], row['next_node'],
-                        row['has_space'], row['count']))
+            append(Edge(self, edge_id, prev, nxt, adj.has_space[edge_id], adj.count[edge_id]))
 
-            last_node = row[1]
+            if direction:
+                last_node = nxt
+            else:
+                last_node = prev
 
     def init(self, order, tokenizer, run_migrations=True):
         c = self.cursor()
@@ -701,6 +1400,66 @@ class Graph:
         c.execute('CREATE UNIQUE INDEX IF NOT EXISTS edges_all_prev ON edges '
                   '(prev_node, next_node, has_space, count)')
 
+    def prune_edges(self, min_count, end_id):
+        """Delete the edges with a count below min_count. Pruning can
+        leave nodes that random walks can enter but never leave, so the
+        edges into and out of those nodes are deleted too, until every
+        node with edges (apart from end_id) has edges in both directions.
+        The edges triggers keep the node counts in step."""
+        self.begin()
+        c = self.cursor()
+
+        deleted = c.execute('DELETE FROM edges WHERE count < ?', (min_count,)).rowcount
+
+        q = '''
+            DELETE FROM edges WHERE
+            prev_node IN (SELECT id FROM nodes WHERE id != :end AND NOT EXISTS
+                          (SELECT 1 FROM edges WHERE next_node = nodes.id))
+            OR next_node IN (SELECT id FROM nodes WHERE id != :end AND NOT EXISTS
+                             (SELECT 1 FROM edges WHERE prev_node = nodes.id))
+        '''
+        dead_ends = 0
+        while True:
+            rowcount = c.execute(q, {'end': end_id}).rowcount
+            if rowcount == 0:
+                break
+            dead_ends += rowcount
+
+        self.clear_caches()
+        if self._adjacency is not None:
+            log.warning('Dropping adjacency cache after pruning')
+            self._adjacency = None
+
+        return {'edges': deleted, 'dead_end_edges': dead_ends}
+
+    def collect_garbage(self, end_id):
+        """Delete the nodes that have no edges, and the tokens and stems
+        that no node uses."""
+        self.begin()
+        c = self.cursor()
+
+        q = '''
+            DELETE FROM nodes WHERE id != ?
+            AND NOT EXISTS (SELECT 1 FROM edges WHERE prev_node = nodes.id)
+            AND NOT EXISTS (SELECT 1 FROM edges WHERE next_node = nodes.id)
+        '''
+        nodes = c.execute(q, (end_id,)).rowcount
+
+        used = ' UNION '.join('SELECT token%d_id FROM nodes' % i for i in range(self.order))
+        tokens = c.execute('DELETE FROM tokens WHERE id NOT IN (%s)' % used).rowcount
+
+        stems = c.execute('DELETE FROM token_stems WHERE token_id NOT IN (SELECT id FROM tokens)').rowcount
+
+        self.clear_caches()
+        return {'nodes': nodes, 'tokens': tokens, 'token_stems': stems}
+
+    def vacuum(self):
+        """Rebuild the database file to reclaim the space left by deleted
+        rows, and refresh the query planner's statistics."""
+        self.commit()
+        self._conn.execute('VACUUM')
+        self._conn.execute('ANALYZE')
+
     def delete_token_stems(self):
         c = self.cursor()
 
@@ -710,6 +1469,7 @@ class Graph:
 
         # delete all the existing stems from the table
         c.execute('DELETE FROM token_stems')
+        self._stem_tokens.clear()
 
         self.commit()
 
@@ -722,6 +1482,7 @@ class Graph:
         for row in q:
             insert_c.execute(insert_q, (row[0], stemmer.stem(row[1])))
         self.commit()
+        self._stem_tokens.clear()
 
         c.execute('CREATE INDEX token_stems_id on token_stems (token_id)')
         c.execute("CREATE INDEX token_stems_stem on token_stems (stem)")
@@ -729,6 +1490,7 @@ class Graph:
     def _run_migrations(self):
         self._maybe_drop_tokens_text_index()
         self._maybe_create_node_count_triggers()
+        self._maybe_create_pivot_tables()
 
     def _maybe_drop_tokens_text_index(self):
         # tokens_text was an index on tokens.text, deemed redundant since
@@ -755,3 +1517,131 @@ class Graph:
         c.execute('CREATE TRIGGER IF NOT EXISTS edges_delete_trigger AFTER '
                   'DELETE ON edges BEGIN UPDATE nodes SET count = count - '
                   'old.count WHERE nodes.id = OLD.next_node; END;')
+
+    def _has_table(self, name):
+        q = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?"
+        return self._conn.execute(q, (name,)).fetchone() is not None
+
+    def _has_column(self, table, name):
+        return any(row['name'] == name for row in self._conn.execute('PRAGMA table_info({})'.format(table)))
+
+    def _fill_token_node_subtotals(self):
+        # build each token's Fenwick tree from the running totals of its
+        # node counts
+        q = 'SELECT token_nodes.token_id, ordinal, count FROM token_nodes ' \
+            'JOIN nodes ON nodes.id = node_id ORDER BY token_nodes.token_id, ordinal'
+        updates = []
+        last_token_id = None
+        for token_id, ordinal, count in self._conn.execute(q).fetchall():
+            if token_id != last_token_id:
+                last_token_id = token_id
+                totals = []
+            totals.append((totals[-1] if totals else 0) + count)
+            start = ordinal & (ordinal + 1)
+            updates.append((totals[ordinal] - (totals[start - 1] if start else 0), token_id, ordinal))
+
+        self._conn.executemany('UPDATE token_nodes SET subtotal = ? WHERE token_id = ? AND ordinal = ?', updates)
+
+    def _maybe_create_pivot_tables(self):
+        # token_nodes lists the nodes that start with each token, and
+        # word_tokens lists the word tokens. Both number their rows with
+        # dense ordinals from 0, so a random row can be picked with a
+        # primary key lookup. Triggers keep the ordinals dense by moving
+        # the last row into the place of a deleted one.
+        #
+        # Pivot nodes are weighted by count, so token_nodes.subtotal also
+        # holds a Fenwick tree of each token's node counts: the row at
+        # ordinal i holds the sum of the counts at ordinals i & (i + 1)
+        # through i. A count change updates the rows at i | (2**k - 1),
+        # so triggers keep the tree in step in O(log n) lookups.
+        self.begin()
+        c = self.cursor()
+
+        if not self._has_table('token_nodes'):
+            log.info('Creating token_nodes table')
+            c.execute('CREATE TABLE token_nodes (token_id INTEGER NOT NULL, ordinal INTEGER NOT NULL, '
+                      'node_id INTEGER NOT NULL, subtotal INTEGER NOT NULL DEFAULT 0, '
+                      'PRIMARY KEY (token_id, ordinal)) WITHOUT ROWID')
+            c.execute('CREATE UNIQUE INDEX token_nodes_node ON token_nodes (node_id)')
+            c.execute('INSERT INTO token_nodes (token_id, ordinal, node_id) '
+                      'SELECT token0_id, row_number() OVER (PARTITION BY token0_id ORDER BY id) - 1, id FROM nodes')
+            self._fill_token_node_subtotals()
+        elif not self._has_column('token_nodes', 'subtotal'):
+            log.info('Adding node count subtotals to token_nodes')
+            c.execute('ALTER TABLE token_nodes ADD COLUMN subtotal INTEGER NOT NULL DEFAULT 0')
+            self._fill_token_node_subtotals()
+            # the old triggers don't maintain the subtotals
+            c.execute('DROP TRIGGER IF EXISTS nodes_insert_trigger')
+            c.execute('DROP TRIGGER IF EXISTS nodes_delete_trigger')
+
+        # a new node's subtotal adds up the subtotals at i - 2**k, the
+        # ranges that make up ordinals i & (i + 1) through i - 1
+        c.execute('CREATE TRIGGER IF NOT EXISTS nodes_insert_trigger AFTER '
+                  'INSERT ON nodes BEGIN INSERT INTO token_nodes (token_id, '
+                  'ordinal, node_id, subtotal) SELECT NEW.token0_id, n, '
+                  'NEW.id, NEW.count + coalesce((SELECT sum(subtotal) FROM '
+                  'token_nodes WHERE token_id = NEW.token0_id AND ordinal >= '
+                  '(n & (n + 1)) AND ordinal IN (SELECT n - 1 - column1 FROM '
+                  '({masks}))), 0) FROM (SELECT coalesce(max(ordinal) + 1, 0) '
+                  'AS n FROM token_nodes WHERE token_id = NEW.token0_id); '
+                  'END;'.format(masks=self.FENWICK_MASKS))
+
+        c.execute('CREATE TRIGGER IF NOT EXISTS nodes_count_trigger AFTER '
+                  'UPDATE OF count ON nodes WHEN NEW.count != OLD.count BEGIN '
+                  'UPDATE token_nodes SET subtotal = subtotal + NEW.count - '
+                  'OLD.count WHERE token_id = NEW.token0_id AND ordinal IN '
+                  '(SELECT ordinal | column1 FROM token_nodes, ({masks}) '
+                  'WHERE node_id = NEW.id); END;'.format(masks=self.FENWICK_MASKS))
+
+        # The last row takes the deleted row's place: its count moves to
+        # the deleted ordinal, and it takes over that ordinal's subtotal.
+        c.execute('CREATE TRIGGER IF NOT EXISTS nodes_delete_trigger AFTER '
+                  'DELETE ON nodes BEGIN '
+                  'UPDATE token_nodes SET subtotal = subtotal + coalesce('
+                  '(SELECT count FROM nodes WHERE id = (SELECT node_id FROM '
+                  'token_nodes WHERE token_id = OLD.token0_id AND ordinal = '
+                  '(SELECT max(ordinal) FROM token_nodes WHERE token_id = '
+                  'OLD.token0_id))), 0) - OLD.count '
+                  'WHERE token_id = OLD.token0_id AND ordinal IN (SELECT '
+                  'ordinal | column1 FROM token_nodes, ({masks}) WHERE '
+                  'node_id = OLD.id); '
+                  'UPDATE token_nodes SET subtotal = (SELECT subtotal FROM '
+                  'token_nodes WHERE node_id = OLD.id) '
+                  'WHERE token_id = OLD.token0_id AND ordinal = (SELECT '
+                  'max(ordinal) FROM token_nodes WHERE token_id = '
+                  'OLD.token0_id) AND node_id != OLD.id; '
+                  'UPDATE token_nodes SET ordinal = -1 - ordinal '
+                  'WHERE node_id = OLD.id; '
+                  'UPDATE token_nodes SET ordinal = (SELECT -1 - ordinal '
+                  'FROM token_nodes WHERE node_id = OLD.id) '
+                  'WHERE token_id = OLD.token0_id AND ordinal = (SELECT '
+                  'max(ordinal) FROM token_nodes WHERE token_id = '
+                  'OLD.token0_id) AND ordinal > (SELECT -1 - ordinal FROM '
+                  'token_nodes WHERE node_id = OLD.id); '
+                  'DELETE FROM token_nodes WHERE node_id = OLD.id; '
+                  'END;'.format(masks=self.FENWICK_MASKS))
+
+        if not self._has_table('word_tokens'):
+            log.info('Creating word_tokens table')
+            c.execute('CREATE TABLE word_tokens (ordinal INTEGER PRIMARY KEY, token_id INTEGER NOT NULL UNIQUE)')
+            c.execute('INSERT INTO word_tokens (ordinal, token_id) '
+                      'SELECT row_number() OVER (ORDER BY id) - 1, id FROM tokens WHERE is_word = 1')
+
+        c.execute('CREATE TRIGGER IF NOT EXISTS tokens_insert_trigger AFTER '
+                  'INSERT ON tokens WHEN NEW.is_word BEGIN INSERT INTO '
+                  'word_tokens (ordinal, token_id) SELECT '
+                  'coalesce(max(ordinal) + 1, 0), NEW.id FROM word_tokens; '
+                  'END;')
+
+        c.execute('CREATE TRIGGER IF NOT EXISTS tokens_delete_trigger AFTER '
+                  'DELETE ON tokens WHEN OLD.is_word BEGIN '
+                  'UPDATE word_tokens SET ordinal = -1 - ordinal '
+                  'WHERE token_id = OLD.id; '
+                  'UPDATE word_tokens SET ordinal = (SELECT -1 - ordinal '
+                  'FROM word_tokens WHERE token_id = OLD.id) '
+                  'WHERE ordinal = (SELECT max(ordinal) FROM word_tokens) '
+                  'AND ordinal > (SELECT -1 - ordinal FROM word_tokens '
+                  'WHERE token_id = OLD.id); '
+                  'DELETE FROM word_tokens WHERE token_id = OLD.id; END;')
+
+        self.commit()
@@ -0,0 +1,106 @@
+import collections
+import re
+import time
+
+
+class LRUCache:
+    """A size-bounded mapping that evicts the least recently used keys and
+    counts hits and misses."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __setitem__(self, key, value):
+        data = self._data
+        data[key] = value
+        data.move_to_end(key)
+        if len(data) > self.maxsize:
+            data.popitem(last=False)
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self._data.move_to_end(key)
+        return value
+
+    def values(self):
+        return self._data.values()
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
+
+class ReplyCache:
+    """Remember the best few replies to recently seen inputs.
+
+    Inputs match when their words match, ignoring case and punctuation. Each
+    entry holds the alternatives found by one reply search, best first, and
+    every get() for the input hands out the next one, so a repeated prompt
+    gets a different reply each time until they run out. An entry expires
+    after ttl seconds, or once max_learned messages have been learned since
+    it was made. A ttl of 0 turns the cache off."""
+
+    WORDS_RE = re.compile(r'\w+')
+
+    def __init__(self, ttl=600, alternatives=4, max_entries=500, max_learned=100, clock=time.monotonic):
+        self.ttl = ttl
+        self.alternatives = alternatives
+        self.max_learned = max_learned
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        # key -> (time made, messages learned when made, deque of replies)
+        self._entries = LRUCache(max_entries)
+
+    @classmethod
+    def key(cls, text):
+        return ' '.join(cls.WORDS_RE.findall(text.casefold()))
+
+    def get(self, text, learned):
+        """Return the next cached reply to text, or None. learned is the
+        number of messages the brain has learned so far."""
+        if self.ttl <= 0:
+            return None
+
+        key = self.key(text)
+        entry = self._entries.get(key)
+        if entry is not None:
+            made, made_learned, replies = entry
+            if self.clock() - made < self.ttl and learned - made_learned < self.max_learned and replies:
+                self.hits += 1
+                return replies.popleft()
+            self._entries.pop(key)
+
+        self.misses += 1
+        return None
+
+    def put(self, text, replies, learned):
+        """Cache replies to text, best first, to be handed out by get()."""
+        if self.ttl > 0 and replies:
+            self._entries[self.key(text)] = (self.clock(), learned, collections.deque(replies))
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
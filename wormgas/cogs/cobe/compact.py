@@ -0,0 +1,363 @@
+import array
+import bisect
+import itertools
+import json
+import logging
+import mmap
+import random
+import struct
+import sys
+
+from . import brain
+from . import instrument
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'COBEMMAP'
+PRELUDE = struct.Struct('<8sQQ')  # magic, header offset, header length
+VERSION = 1
+
+# token flags
+TOKEN_EXISTS = 1
+TOKEN_IS_WORD = 2
+
+
+def is_compact(filename):
+    """Return True if filename is a compact brain."""
+    try:
+        with open(filename, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def _segments(keys, size):
+    # offsets[k]:offsets[k + 1] is the run of each key in a sorted sequence
+    offsets = array.array('q', itertools.repeat(0, size + 1))
+    for key in keys:
+        offsets[key + 1] += 1
+    for i in range(1, len(offsets)):
+        offsets[i] += offsets[i - 1]
+    return offsets
+
+
+def _cumulative(weights, offsets):
+    # cumulative weights, restarting at the start of each segment
+    cumulative = array.array('q', weights)
+    for start, end in zip(offsets, offsets[1:]):
+        for i in range(start + 1, end):
+            cumulative[i] += cumulative[i - 1]
+    return cumulative
+
+
+def export(conn, filename):
+    """Write the sqlite brain on conn to filename in the compact format.
+
+    The file holds the info table as a JSON header, and flat arrays for
+    everything else: a string table of tokens, fixed-width token id tuples
+    for nodes, and edges in CSR form (per-node offsets into edge arrays,
+    with cumulative counts for weighted sampling) for both directions."""
+    info = {row[0]: row[1] for row in conn.execute('SELECT attribute, text FROM info')}
+    order = int(info['order'])
+    sections = {}
+
+    max_token_id = conn.execute('SELECT max(id) FROM tokens').fetchone()[0] or 0
+    texts = [b''] * (max_token_id + 1)
+    flags = bytearray(max_token_id + 1)
+    for token_id, text, is_word in conn.execute('SELECT id, text, is_word FROM tokens'):
+        texts[token_id] = text.encode('utf-8')
+        flags[token_id] = TOKEN_EXISTS | (TOKEN_IS_WORD if is_word else 0)
+    token_ids = [token_id for token_id in range(max_token_id + 1) if flags[token_id]]
+
+    sections['token_offsets'] = array.array('q', itertools.accumulate(itertools.chain([0], map(len, texts))))
+    sections['token_text'] = array.array('B', b''.join(texts))
+    sections['token_flags'] = array.array('B', flags)
+    sections['tokens_by_text'] = array.array('i', sorted(token_ids, key=texts.__getitem__))
+
+    stems = [b''] * (max_token_id + 1)
+    for token_id, stem in conn.execute('SELECT token_id, stem FROM token_stems'):
+        stems[token_id] = stem.encode('utf-8')
+    stemmed = [token_id for token_id in token_ids if stems[token_id]]
+    sections['stem_offsets'] = array.array('q', itertools.accumulate(itertools.chain([0], map(len, stems))))
+    sections['stem_text'] = array.array('B', b''.join(stems))
+    sections['tokens_by_stem'] = array.array('i', sorted(stemmed, key=stems.__getitem__))
+
+    max_node_id = conn.execute('SELECT max(id) FROM nodes').fetchone()[0] or 0
+    node_tokens = array.array('i', itertools.repeat(0, (max_node_id + 1) * order))
+    node_counts = array.array('q', itertools.repeat(0, max_node_id + 1))
+    node_ids = []
+    q = 'SELECT id, count, {} FROM nodes'.format(','.join('token{}_id'.format(i) for i in range(order)))
+    for row in conn.execute(q):
+        node_id = row[0]
+        node_ids.append(node_id)
+        node_counts[node_id] = row[1]
+        node_tokens[node_id * order:(node_id + 1) * order] = array.array('i', row[2:])
+    sections['node_tokens'] = node_tokens
+    sections['node_count'] = node_counts
+    sections['nodes_by_tokens'] = array.array('i', sorted(
+        node_ids, key=lambda n: tuple(node_tokens[n * order:(n + 1) * order])))
+
+    # pivot nodes for each token, and the tokens that can be pivots
+    first_tokens = [node_tokens[node_id * order] for node_id in node_ids]
+    by_first_token = sorted(range(len(node_ids)), key=first_tokens.__getitem__)
+    offsets = _segments(first_tokens, max_token_id + 1)
+    sections['token_node_offsets'] = offsets
+    sections['token_nodes'] = array.array('i', (node_ids[i] for i in by_first_token))
+    sections['token_node_cumulative'] = _cumulative((node_counts[node_ids[i]] for i in by_first_token), offsets)
+    sections['pivot_tokens'] = array.array('i', (
+        token_id for token_id in token_ids
+        if flags[token_id] & TOKEN_IS_WORD and offsets[token_id + 1] > offsets[token_id]))
+
+    # edges sorted by prev_node are the forward index
+    edge_id, edge_prev, edge_next = array.array('i'), array.array('i'), array.array('i')
+    edge_space, edge_count = array.array('B'), array.array('q')
+    q = 'SELECT id, prev_node, next_node, has_space, count FROM edges ORDER BY prev_node, id'
+    for row in conn.execute(q):
+        for column, value in zip((edge_id, edge_prev, edge_next, edge_space, edge_count), row):
+            column.append(value)
+    forward_offsets = _segments(edge_prev, max_node_id + 1)
+    sections['edge_id'] = edge_id
+    sections['edge_prev'] = edge_prev
+    sections['edge_next'] = edge_next
+    sections['edge_space'] = edge_space
+    sections['edge_count'] = edge_count
+    sections['forward_offsets'] = forward_offsets
+    sections['forward_cumulative'] = _cumulative(edge_count, forward_offsets)
+
+    backward = sorted(range(len(edge_id)), key=edge_next.__getitem__)
+    backward_offsets = _segments(edge_next, max_node_id + 1)
+    sections['backward_offsets'] = backward_offsets
+    sections['backward_edges'] = array.array('i', backward)
+    sections['backward_cumulative'] = _cumulative((edge_count[i] for i in backward), backward_offsets)
+
+    header = {'version': VERSION, 'byteorder': sys.byteorder, 'info': info, 'sections': {}}
+    with open(filename, 'wb') as f:
+        f.write(bytes(PRELUDE.size))
+        for name, data in sections.items():
+            # keep every array aligned to 8 bytes
+            f.write(bytes(-f.tell() % 8))
+            header['sections'][name] = [f.tell(), data.typecode, len(data)]
+            data.tofile(f)
+
+        header_bytes = json.dumps(header).encode('utf-8')
+        header_offset = f.tell()
+        f.write(header_bytes)
+        f.seek(0)
+        f.write(PRELUDE.pack(MAGIC, header_offset, len(header_bytes)))
+
+
+class CompactGraph:
+    """A read-only Graph backed by a memory-mapped compact brain.
+
+    Opening the file only parses its header, and every lookup reads
+    directly from the mapped arrays, so the brain starts quickly and its
+    pages are shared by every process that maps it. Walks and pivot nodes
+    are weighted by edge and node counts, like the adjacency cache."""
+
+    def __init__(self, filename, rng=None):
+        self.random = rng or random.Random()
+        self._file = open(filename, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+
+        magic, header_offset, header_length = PRELUDE.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise brain.CobeError('{} is not a compact brain'.format(filename))
+        header = json.loads(bytes(self._view[header_offset:header_offset + header_length]))
+        if header['version'] != VERSION or header['byteorder'] != sys.byteorder:
+            raise brain.CobeError('cannot read compact brain {}'.format(filename))
+
+        self._info = header['info']
+        self._arrays = []
+        for name, (offset, typecode, length) in header['sections'].items():
+            itemsize = array.array(typecode).itemsize
+            data = self._view[offset:offset + length * itemsize].cast(typecode)
+            self._arrays.append(data)
+            setattr(self, name, data)
+
+        self.order = int(self._info['order'])
+
+    def close(self):
+        for data in self._arrays:
+            data.release()
+        self._view.release()
+        self._mmap.close()
+        self._file.close()
+
+    def _read_only(self, *args, **kwargs):
+        raise brain.CobeError('compact brains are read-only')
+
+    cursor = begin = commit = rollback = insert_stems = add_edge = add_edges = _read_only
+
+    def load_adjacency(self, max_edges=None):
+        # walks already read the edge arrays from the mapped file
+        return True
+
+    def unload_adjacency(self):
+        pass
+
+    def adjacency_memory_usage(self):
+        return 0
+
+    def check_data_version(self):
+        pass
+
+    def clear_caches(self):
+        pass
+
+    def cache_stats(self):
+        return {}
+
+    def start_query_stats(self):
+        # there is no SQL to count
+        return instrument.QueryStats()
+
+    def stop_query_stats(self):
+        pass
+
+    def get_info_text(self, attribute, default=None, text_factory=None):
+        return self._info.get(attribute, default)
+
+    def _text(self, token_id):
+        return bytes(self.token_text[self.token_offsets[token_id]:self.token_offsets[token_id + 1]])
+
+    def _stem(self, token_id):
+        return bytes(self.stem_text[self.stem_offsets[token_id]:self.stem_offsets[token_id + 1]])
+
+    def _node_tokens(self, node_id):
+        return tuple(self.node_tokens[node_id * self.order:(node_id + 1) * self.order])
+
+    @staticmethod
+    def _search(index, key_of, key):
+        # index of the first item in the sorted index whose key is >= key
+        lo, hi = 0, len(index)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key_of(index[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _has_token(self, token_id):
+        return 0 <= token_id < len(self.token_flags) and self.token_flags[token_id] & TOKEN_EXISTS
+
+    def get_token_by_text(self, text, create=False, stemmer=None):
+        return self.get_tokens_by_text([text], create, stemmer).get(text)
+
+    def get_tokens_by_text(self, texts, create=False, stemmer=None):
+        result = {}
+        for text in set(texts):
+            key = text.encode('utf-8')
+            i = self._search(self.tokens_by_text, self._text, key)
+            if i < len(self.tokens_by_text) and self._text(self.tokens_by_text[i]) == key:
+                result[text] = self.tokens_by_text[i]
+            elif create:
+                self._read_only()
+        return result
+
+    def get_token_by_id(self, token_id):
+        return self.get_token_texts([token_id]).get(token_id)
+
+    def get_token_texts(self, token_ids):
+        return {token_id: self._text(token_id).decode('utf-8')
+                for token_id in token_ids if self._has_token(token_id)}
+
+    def get_tokens_by_stems(self, stems):
+        return {stem: self.get_token_stem_id(stem) for stem in set(stems)}
+
+    def get_token_stem_id(self, stem):
+        key = stem.encode('utf-8')
+        index = self.tokens_by_stem
+        token_ids = []
+        for i in range(self._search(index, self._stem, key), len(index)):
+            if self._stem(index[i]) != key:
+                break
+            token_ids.append(index[i])
+        return tuple(token_ids)
+
+    def get_word_flags(self, token_ids):
+        return {token_id: bool(self.token_flags[token_id] & TOKEN_IS_WORD)
+                for token_id in token_ids if self._has_token(token_id)}
+
+    def get_word_tokens(self, token_ids):
+        return [token_id for token_id in token_ids
+                if self._has_token(token_id) and self.token_flags[token_id] & TOKEN_IS_WORD]
+
+    def get_tokens(self, token_ids):
+        return [token_id for token_id in token_ids if self._has_token(token_id)]
+
+    def get_random_token(self):
+        if len(self.pivot_tokens) > 0:
+            return self.pivot_tokens[self.random.randrange(len(self.pivot_tokens))]
+
+    def get_node_by_tokens(self, tokens):
+        tokens = tuple(tokens)
+        return self.get_nodes_by_tokens([tokens])[tokens]
+
+    def get_nodes_by_tokens(self, token_tuples):
+        result = {}
+        index = self.nodes_by_tokens
+        for tokens in set(token_tuples):
+            i = self._search(index, self._node_tokens, tokens)
+            if i < len(index) and self._node_tokens(index[i]) == tokens:
+                result[tokens] = index[i]
+            else:
+                self._read_only()
+        return result
+
+    def get_node_tokens(self, node_id):
+        return self._node_tokens(node_id)
+
+    def get_node_text(self, node_id):
+        return [self.get_token_by_id(token_id) for token_id in self._node_tokens(node_id)]
+
+    def get_token_by_node(self, node_id):
+        return self.node_tokens[(node_id + 1) * self.order - 1]
+
+    def get_tokens_by_nodes(self, node_ids):
+        return {node_id: self.get_token_by_node(node_id) for node_id in node_ids}
+
+    def get_word_by_node(self, node_id):
+        return self._text(self.get_token_by_node(node_id)).decode('utf-8')
+
+    def get_words_by_nodes(self, node_ids):
+        return {node_id: self.get_word_by_node(node_id) for node_id in node_ids}
+
+    def get_node_count(self, node_id):
+        return self.node_count[node_id]
+
+    def get_node_counts(self, node_ids):
+        return {node_id: self.node_count[node_id] for node_id in node_ids}
+
+    def _choose(self, cumulative, start, end):
+        # index in start:end, weighted by the segment's cumulative counts
+        if end <= start or cumulative[end - 1] == 0:
+            return None
+        return start + bisect.bisect_right(cumulative[start:end], self.random.randrange(cumulative[end - 1]))
+
+    def get_random_node_with_token(self, token_id):
+        if not 0 <= token_id < len(self.token_node_offsets) - 1:
+            return None
+        i = self._choose(self.token_node_cumulative,
+                         self.token_node_offsets[token_id], self.token_node_offsets[token_id + 1])
+        if i is not None:
+            return self.token_nodes[i]
+
+    def walk(self, node, end_id, direction, append):
+        """Perform a random walk on the graph starting at node"""
+        last_node = node
+
+        while last_node != end_id:
+            if direction:
+                i = self._choose(self.forward_cumulative,
+                                 self.forward_offsets[last_node], self.forward_offsets[last_node + 1])
+                last_node = self.edge_next[i]
+            else:
+                j = self._choose(self.backward_cumulative,
+                                 self.backward_offsets[last_node], self.backward_offsets[last_node + 1])
+                i = self.backward_edges[j]
+                last_node = self.edge_prev[i]
+
+            append(brain.Edge(self, self.edge_id[i], self.edge_prev[i], self.edge_next[i],
+                              self.edge_space[i], self.edge_count[i]))
@@ -0,0 +1,277 @@
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+
+from . import brain
+
+log = logging.getLogger(__name__)
+
+
+class BrainExecutor:
+    """Run a Brain on a dedicated worker thread.
+
+    The worker thread opens the brain and owns its sqlite connection for
+    the lifetime of the executor. Calls are queued in the order they are
+    made and exposed as coroutines, so the asyncio event loop never blocks
+    on learning or replying.
+
+    With readers, replies run on a pool of reader threads instead, each
+    with its own read-only connection. In WAL mode (see brain.GraphOptions)
+    those connections read the last committed state of the brain while
+    the worker thread is learning, so replies never wait for learning.
+    Readers don't use the adjacency cache: it is updated as the worker
+    thread learns, and reloading it for every reader after each commit
+    would cost more than it saves. So adjacency_max_edges is ignored when
+    readers is set.
+
+    With instrument, every brain counts and times its SQL queries and
+    records cache hit rates in its reply and learn stats."""
+
+    def __init__(self, filename, timeout=10.0, max_pending=100, adjacency_max_edges=0, reply_workers=0,
+                 reply_snapshot=None, readers=0, options=None, instrument=False):
+        self.filename = filename
+        self.adjacency_max_edges = adjacency_max_edges
+        self.reply_workers = reply_workers
+        self.reply_snapshot = reply_snapshot
+        self.readers = readers
+        self.options = options
+        self.instrument = instrument
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.pending = 0
+        self.last_reply_stats = None
+        self.last_learn_stats = None
+        self.brain = None
+        self._opened = threading.Event()
+        self._local = threading.local()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='brain')
+        # checked by _run, so calls fail with CobeError if the brain could not be opened
+        self._open_future = self._executor.submit(self._open)
+
+        self._reader_executor = None
+        if readers:
+            self._reader_executor = concurrent.futures.ThreadPoolExecutor(max_workers=readers,
+                                                                          thread_name_prefix='brain-reader')
+
+    def _open(self):
+        log.info(f'Opening brain {self.filename}')
+        try:
+            self.brain = brain.Brain(self.filename, options=self.options)
+            self.brain.instrument = self.instrument
+            if self.adjacency_max_edges:
+                if self.readers:
+                    # the cache is only kept in step with the writer's connection
+                    log.warning('Not loading adjacency cache: replies run on reader connections, which do not use it')
+                else:
+                    self.brain.graph.load_adjacency(self.adjacency_max_edges)
+            if self.reply_workers:
+                self.brain.start_reply_workers(self.reply_workers, self.reply_snapshot)
+        except Exception:
+            log.exception(f'Failed to open brain {self.filename}')
+            if self.brain is not None:
+                self.brain.graph.close()
+                self.brain = None
+            raise
+        finally:
+            self._opened.set()
+
+    def _writer(self):
+        # calls queued before _open failed run after it on the worker thread
+        if self.brain is None:
+            raise brain.CobeError(f'Brain {self.filename} is not open')
+        return self.brain
+
+    def _reader(self):
+        # each reader thread opens its connection on first use
+        reader = getattr(self._local, 'brain', None)
+        if reader is None:
+            self._opened.wait()
+            self._writer()
+            log.info(f'Opening read-only brain {self.filename}')
+            reader = brain.Brain(self.filename, readonly=True, options=self.options)
+            reader.instrument = self.instrument
+            if self.brain is not None and self.reply_workers:
+                reader.share_reply_workers(self.brain)
+            self._local.brain = reader
+        return reader
+
+    async def _run(self, func, *args, timeout=None, executor=None):
+        if self.pending >= self.max_pending:
+            raise BrainBusyError(f'{self.pending} brain calls are already pending')
+        if self._open_future.done() and self._open_future.exception() is not None:
+            raise brain.CobeError(f'Could not open brain {self.filename}') from self._open_future.exception()
+        if timeout is None:
+            timeout = self.timeout
+        if executor is None:
+            executor = self._executor
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        try:
+            # If the wait times out or is cancelled before the worker
+            # thread picks up the call, the call is dropped from the queue.
+            return await asyncio.wait_for(loop.run_in_executor(executor, func, *args), timeout)
+        finally:
+            self.pending -= 1
+
+    def _learn(self, text):
+        b = self._writer()
+        b.learn(text)
+        return b.last_learn_stats
+
+    def _reply(self, text, budget, count):
+        b = self._writer() if self._reader_executor is None else self._reader()
+        return b.replies(text, budget, count), b.last_reply_stats
+
+    def _learn_batch(self, texts):
+        b = self._writer()
+        b.learn_batch(texts)
+        return b.last_learn_stats
+
+    def submit_learn_batch(self, texts):
+        """Queue a list of strings to be learned and committed together.
+        Returns a concurrent.futures.Future of the brain's learn stats."""
+        return self._executor.submit(self._learn_batch, texts)
+
+    async def learn(self, text, timeout=None):
+        """Learn a string of text."""
+        self.last_learn_stats = await self._run(self._learn, text, timeout=timeout)
+
+    async def reply(self, text, budget=None, timeout=None):
+        """Reply to a string of text, within a brain.ReplyBudget."""
+        replies = await self.replies(text, budget, timeout=timeout)
+        if not replies:
+            return brain.Brain.NO_REPLY
+        return replies[0]
+
+    async def replies(self, text, budget=None, count=1, timeout=None):
+        """Reply to a string of text with up to count different replies,
+        best first, from one search within a brain.ReplyBudget."""
+        replies, self.last_reply_stats = await self._run(self._reply, text, budget, count, timeout=timeout,
+                                                         executor=self._reader_executor)
+        return replies
+
+    def close(self):
+        """Stop accepting calls and close the brain after pending calls finish."""
+        if self._reader_executor is not None:
+            # reader connections are closed when their threads exit
+            self._reader_executor.shutdown(wait=False)
+        self._executor.submit(self._close)
+        self._executor.shutdown(wait=False)
+
+    def _close(self):
+        if self.brain is not None:
+            self.brain.stop_reply_workers()
+            self.brain.graph.close()
+            self.brain = None
+
+
+class LearnQueue:
+    """Learn text in the background, in batches.
+
+    Text is queued in memory and learned by run(), which sends a batch to
+    the brain when batch_size messages are waiting or the oldest has waited
+    batch_ms milliseconds. Each batch is learned in one transaction, so the
+    brain commits once per batch instead of once per message. When max_size
+    messages are waiting, new messages are dropped."""
+
+    def __init__(self, brain_executor, max_size=1000, batch_size=50, batch_ms=1000):
+        self.brain = brain_executor
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.batch_ms = batch_ms
+        self.learned = 0
+        self.dropped = 0
+        self.batches = 0
+        # the brain's stats for the last batch learned
+        self.last_batch_stats = None
+        self._full = False
+        # (time queued, text)
+        self._pending = collections.deque()
+        self._batch = []
+        self._ready = asyncio.Event()
+
+    @property
+    def depth(self):
+        """The number of messages that have not been committed yet."""
+        return len(self._pending) + len(self._batch)
+
+    @property
+    def lag(self):
+        """Seconds since the oldest message that has not been committed
+        yet was queued."""
+        oldest = self._batch or self._pending
+        if not oldest:
+            return 0.0
+        return time.monotonic() - oldest[0][0]
+
+    def stats(self):
+        return {'depth': self.depth, 'lag': self.lag, 'learned': self.learned, 'dropped': self.dropped,
+                'batches': self.batches}
+
+    def put(self, text):
+        """Queue text to be learned. Returns False if the queue is full."""
+        if len(self._pending) >= self.max_size:
+            if not self._full:
+                log.warning('Learn queue is full, dropping messages until the brain catches up')
+                self._full = True
+            self.dropped += 1
+            return False
+        self._full = False
+        self._pending.append((time.monotonic(), text))
+        self._ready.set()
+        return True
+
+    async def _wait_for_batch(self):
+        await self._ready.wait()
+        while len(self._pending) < self.batch_size:
+            delay = self._pending[0][0] + self.batch_ms / 1000 - time.monotonic()
+            if delay <= 0:
+                return
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), delay)
+            except asyncio.TimeoutError:
+                return
+
+    async def run(self):
+        """Learn queued text until cancelled."""
+        while True:
+            await self._wait_for_batch()
+
+            while self._pending and len(self._batch) < self.batch_size:
+                self._batch.append(self._pending.popleft())
+            if not self._pending:
+                self._ready.clear()
+
+            texts = [text for _, text in self._batch]
+            try:
+                # If this task is cancelled, the batch is still learned.
+                self.last_batch_stats = await asyncio.shield(
+                    asyncio.wrap_future(self.brain.submit_learn_batch(texts)))
+                self.learned += len(texts)
+                self.batches += 1
+                log.debug(f'Learned {len(texts)} messages, {len(self._pending)} still queued')
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception(f'Failed to learn a batch of {len(texts)} messages')
+            finally:
+                self._batch = []
+
+    def flush(self):
+        """Send every queued message to the brain without waiting. Call
+        this after cancelling run(), before closing the brain."""
+        if self._pending:
+            texts = [text for _, text in self._pending]
+            log.info(f'Flushing {len(texts)} queued messages to the brain')
+            self.brain.submit_learn_batch(texts)
+            self.learned += len(texts)
+            self._pending.clear()
+        self._ready.clear()
+
+
+class BrainBusyError(brain.CobeError):
+    pass
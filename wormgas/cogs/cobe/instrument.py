@@ -0,0 +1,125 @@
+import time
+
+
+class QueryStats:
+    """The number of SQL statements run on a connection, and the seconds
+    spent running them and fetching their rows."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+class TimedCursor:
+    """A sqlite3 cursor that adds the statements it runs to a QueryStats."""
+
+    def __init__(self, cursor, stats):
+        self._cursor = cursor
+        self._stats = stats
+
+    def _timed(self, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self._stats.seconds += time.perf_counter() - start
+
+    def execute(self, sql, parameters=()):
+        self._stats.count += 1
+        self._timed(self._cursor.execute, sql, parameters)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self._stats.count += 1
+        self._timed(self._cursor.executemany, sql, seq_of_parameters)
+        return self
+
+    def fetchone(self):
+        return self._timed(self._cursor.fetchone)
+
+    def fetchall(self):
+        return self._timed(self._cursor.fetchall)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self._timed(next, self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class TimedConnection:
+    """A sqlite3 connection whose cursors add the statements they run to a
+    QueryStats. Everything else is passed through to the connection."""
+
+    def __init__(self, conn, stats):
+        self._conn = conn
+        self._stats = stats
+
+    def cursor(self):
+        return TimedCursor(self._conn.cursor(), self._stats)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def hit_rates(before, after):
+    """Compare two snapshots of cache stats ({name: LRUCache.stats()}) and
+    return {name: fraction of lookups that hit} for each cache that was used
+    in between."""
+    rates = {}
+    for name, stats in after.items():
+        old = before.get(name, {})
+        hits = stats['hits'] - old.get('hits', 0)
+        lookups = hits + stats['misses'] - old.get('misses', 0)
+        if lookups > 0:
+            rates[name] = hits / lookups
+    return rates
+
+
+class Recorder:
+    """Count and time the SQL statements a graph runs, and the hits and
+    misses of a set of caches, from construction until stop()."""
+
+    def __init__(self, graph, cache_stats):
+        self.graph = graph
+        self.cache_stats = cache_stats
+        self._before = cache_stats()
+        self._after = None
+        self.queries = graph.start_query_stats()
+
+    def stop(self):
+        self.graph.stop_query_stats()
+        self._after = self.cache_stats()
+
+    def add_to(self, stats):
+        """Add the queries and cache hit rates to a stats dict."""
+        stats['queries'] = self.queries.count
+        stats['query_ms'] = self.queries.seconds * 1000
+        stats['cache_hit_rates'] = hit_rates(self._before, self._after)
+        return stats
+
+
+def summary(stats):
+    """Format a reply or learn stats dict as one line for logs and chat."""
+    parts = ['{:.1f}ms'.format(stats['ms'])]
+    parts.append(', '.join('{} {:.1f}ms'.format(name, ms) for name, ms in stats['phases_ms'].items()))
+    if 'candidates' in stats:
+        parts.append('{candidates} candidates, {scored} scored, {duplicates} duplicates, '
+                     'stopped on {stop_reason}'.format(**stats))
+    if 'messages' in stats:
+        parts.append('{messages} messages, {tokens} tokens'.format(**stats))
+    if 'queries' in stats:
+        parts.append('{queries} queries in {query_ms:.1f}ms'.format(**stats))
+        if stats['cache_hit_rates']:
+            parts.append('cache hits ' + ', '.join(
+                '{} {:.0%}'.format(name, rate) for name, rate in sorted(stats['cache_hit_rates'].items())))
+    return '; '.join(parts)
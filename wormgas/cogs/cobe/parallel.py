@@ -0,0 +1,114 @@
+import collections
+import concurrent.futures
+import logging
+import multiprocessing
+import time
+
+from concurrent.futures.process import BrokenProcessPool
+
+from . import brain
+
+log = logging.getLogger(__name__)
+
+# the read-only brain in each worker process
+_brain = None
+
+
+def _init_worker(filename):
+    global _brain
+    _brain = brain.Brain(filename, readonly=True)
+
+
+def _ping():
+    return True
+
+
+def _best_replies(text, end, budget, count):
+    replies, stats = _brain.best_replies(text, end, budget, count)
+    texts = _brain.reply_texts([reply for _, reply in replies], stats)
+    return [(float(score), reply_text) for (score, _), reply_text in zip(replies, texts)], stats
+
+
+class ReplyPool:
+    """A pool of worker processes that generate and score reply candidates
+    in parallel. Each worker opens the brain with its own read-only
+    connection, and every worker spends the whole reply window on one
+    request, so the number of candidates scored grows with the number of
+    workers."""
+
+    # seconds to wait for the workers to start and open the brain
+    START_TIMEOUT = 60
+    # seconds to wait for the workers' replies after the reply window ends
+    REPLY_GRACE = 5
+
+    def __init__(self, filename, workers):
+        self.workers = workers
+        # Don't fork: the bot process has an event loop and other threads.
+        context = multiprocessing.get_context('spawn')
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, mp_context=context, initializer=_init_worker, initargs=(filename,))
+
+        self.broken = False
+
+        # start the workers and open their brains now, not in the first
+        # reply window
+        children = set(multiprocessing.active_children())
+        futures = [self._executor.submit(_ping) for _ in range(workers)]
+        # the processes the executor started for the pings
+        self._processes = [process for process in multiprocessing.active_children() if process not in children]
+        done, not_done = concurrent.futures.wait(futures, self.START_TIMEOUT)
+        try:
+            if not_done:
+                raise brain.CobeError(f'{len(not_done)} of {workers} reply workers did not start '
+                                      f'in {self.START_TIMEOUT}s')
+            for future in done:
+                future.result()
+        except Exception:
+            self._terminate()
+            raise
+        log.info(f'Started {workers} reply workers for {filename}')
+
+    def _terminate(self):
+        # Workers that are stuck never pick up the shutdown request, so
+        # stop them.
+        self.broken = True
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        for process in self._processes:
+            process.terminate()
+
+    def reply(self, text, end, budget, count=1):
+        """Reply to a string of text, using every worker until the time end
+        or until the budget runs out. Returns a list of up to count
+        different reply texts, best first, and the combined stats of the
+        workers. Raises BrokenProcessPool if a worker has died, or has not
+        answered REPLY_GRACE seconds after end."""
+        if self.broken:
+            raise BrokenProcessPool('The reply workers were stopped')
+        budget = budget.split(self.workers)
+        futures = [self._executor.submit(_best_replies, text, end, budget, count) for _ in range(self.workers)]
+
+        scored = []
+        stop_reasons = set()
+        totals = collections.Counter()
+        phases = collections.Counter()
+        for future in futures:
+            try:
+                replies, stats = future.result(max(0, end - time.time()) + self.REPLY_GRACE)
+            except concurrent.futures.TimeoutError:
+                self._terminate()
+                raise BrokenProcessPool(f'A reply worker did not answer {self.REPLY_GRACE}s after the reply window')
+            scored.extend(replies)
+
+            stop_reasons.add(stats['stop_reason'])
+            totals.update({key: stats[key] for key in ('candidates', 'scored', 'duplicates')})
+            phases.update(stats['phases_ms'])
+
+        # the phases are summed over the workers, so they can add up to more
+        # than the time the reply took
+        stats = dict(totals, stop_reason=','.join(sorted(stop_reasons)), phases_ms=dict(phases))
+        # the same text can come from several workers
+        texts = dict.fromkeys(reply_text for _, reply_text in sorted(scored, key=lambda r: r[0], reverse=True))
+        return list(texts)[:count], stats
+
+    def close(self):
+        self._executor.shutdown(wait=False)
@@ -2,6 +2,7 @@
 # Edited 2015-02-11 for simplicity and Python 3 compatibility by William Jackson
 
 import math
+import numpy as np
 
 from itertools import islice
 
@@ -24,6 +25,10 @@ class Scorer:
     def score(self, reply):
         return NotImplementedError
 
+    def score_batch(self, replies):
+        """Score a sequence of replies, returning an array of scores."""
+        return np.array([self.score(reply) for reply in replies], dtype=float)
+
 
 class ScorerGroup:
     def __init__(self):
@@ -60,28 +65,29 @@ class ScorerGroup:
 
         return score / self.total_weight
 
+    def score_batch(self, replies):
+        scores = np.zeros(len(replies))
+        for weight, scorer in self.scorers:
+            s = scorer.score_batch(replies)
 
-class CobeScorer(Scorer):
-    """Classic Cobe scorer"""
-    def score(self, reply):
-        info = 0.
+            if weight < 0.0:
+                s = 1.0 - s
 
-        cache = self.cache
-        nodes = set()
+            scores += abs(weight) * s
 
-        for edge in reply.edges:
-            node_id = edge.prev
+        return scores / self.total_weight
 
-            if node_id not in cache:
-                nodes.add(node_id)
 
-        counts = reply.graph.get_node_counts(nodes)
+class CobeScorer(Scorer):
+    """Classic Cobe scorer"""
+    def score(self, reply):
+        info = 0.
 
-        for node_id, count in counts:
-            cache[node_id] = count
+        # node counts are cached by the graph
+        counts = reply.graph.get_node_counts(edge.prev for edge in reply.edges)
 
         for edge in reply.edges:
-            node_count = cache[edge.prev]
+            node_count = counts[edge.prev]
             info += -math.log(float(edge.count) / node_count, 2)
 
         # Approximate the number of cobe 1.2 contexts in this reply, so the
@@ -114,21 +120,40 @@ class CobeScorer(Scorer):
 
         return self.normalize(info)
 
+    def score_batch(self, replies):
+        """Score many replies at once. This matches score(), but looks up
+        all the node counts it needs in one query and does the arithmetic
+        on flat arrays of edges."""
+        if len(replies) == 0:
+            return np.zeros(0)
+
+        graph = replies[0].graph
+        edges = [edge for reply in replies for edge in reply.edges]
+        counts = graph.get_node_counts(edge.prev for edge in edges)
+
+        n = len(edges)
+        edge_counts = np.fromiter((edge.count for edge in edges), dtype=float, count=n)
+        node_counts = np.fromiter((counts[edge.prev] for edge in edges), dtype=float, count=n)
+        spaces = np.fromiter((edge.has_space for edge in edges), dtype=int, count=n)
+
+        # each reply is a run of consecutive edges
+        lengths = np.fromiter((len(reply.edges) for reply in replies), dtype=int, count=len(replies))
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+
+        info = np.add.reduceat(-np.log(edge_counts / node_counts) / math.log(2), starts)
+        n_words = lengths - (graph.order - 1) * 2 + np.add.reduceat(spaces, starts)
+
+        info *= 2.0
+        info = np.where(n_words > 16, info / np.sqrt(np.maximum(n_words - 1, 1)), info)
+
+        return np.where(info < 0, info, 1.0 - 1.0 / (1.0 + info))
+
 
 class IdentityScorer(Scorer):
     """Parrot the input exactly. Best used with a negative weight."""
     def token_iter(self, reply):
-        cache = self.cache
-
+        # node tokens are cached by the graph
         for edge in islice(reply.edges, 1, None):
-            node_id = edge.prev
-
-            if node_id in cache:
-                token = cache[node_id]
-            else:
-                token = edge.get_prev_token()
-                cache[node_id] = token
-
             yield edge.get_prev_token()
             if edge.has_space:
                 yield None
@@ -4,6 +4,8 @@
 import re
 import stemming.porter2
 
+from . import cache
+
 
 class MegaHALTokenizer:
     """A traditional MegaHAL style tokenizer. This considers any of these
@@ -13,8 +15,10 @@ to be a token:
   * one or more consecutive punctuation/space characters (not apostrophe)
 
 This tokenizer ignores differences in capitalization."""
-    @staticmethod
-    def split(phrase):
+    regex = re.compile('([A-Z\']+|[0-9]+|[^A-Z\'0-9]+)', re.UNICODE)
+
+    @classmethod
+    def split(cls, phrase):
         if not isinstance(phrase, str):
             raise TypeError('Input must be Unicode')
 
@@ -25,8 +29,7 @@ This tokenizer ignores differences in capitalization."""
         if phrase[-1] not in '.!?':
             phrase = '{}.'.format(phrase)
 
-        words = re.findall('([A-Z\']+|[0-9]+|[^A-Z\'0-9]+)', phrase.upper(),
-                           re.UNICODE)
+        words = cls.regex.findall(phrase.upper())
         return words
 
     @staticmethod
@@ -111,16 +114,22 @@ tokens."""
 
 
 class CobeStemmer:
-    def __init__(self):
-        pass
-
-    @staticmethod
-    def stem(word):
-        # Don't preserve case when stemming, i.e. create lowercase stems.
-        # This will allow us to create replies that switch the case of
-        # input words, but still generate the reply in context with the
-        # generated case.
-
-        stem = stemming.porter2.stem(word.lower())
+    """A porter2 stemmer that remembers the stems of the most recently
+    used cache_size words."""
+
+    CACHE_SIZE = 100000
+
+    def __init__(self, cache_size=CACHE_SIZE):
+        self.cache = cache.LRUCache(cache_size)
+
+    def stem(self, word):
+        stem = self.cache.get(word)
+        if stem is None:
+            # Don't preserve case when stemming, i.e. create lowercase stems.
+            # This will allow us to create replies that switch the case of
+            # input words, but still generate the reply in context with the
+            # generated case.
+            stem = stemming.porter2.stem(word.lower())
+            self.cache[word] = stem
 
         return stem
@@ -16,7 +16,7 @@ class ConfigCog(cmds.Cog):
         """Display or change configuration settings.
 
         Use "!set [<id>] [<value>]" to display or change configuration settings.
-        Leave off <value> to see the current setting.
+        Leave off <value> to see the current setting, or the config ids that start with <id>.
         Leave off <id> and <value> to see a list of all available config ids.
         """
 
@@ -28,18 +28,31 @@ class ConfigCog(cmds.Cog):
         elif len(tokens) > 0:
             key = tokens[0]
             value = self.bot.config.get(key)
-            if value is None:
-                await ctx.author.send(f'{key} is not set.')
-            else:
+            if value is not None:
                 await ctx.author.send(f'{key} = {value}')
+                return
+            config_ids = self.bot.config.keys_with_prefix(key)
+            if config_ids:
+                await self.send_ids(ctx, config_ids)
+            else:
+                await ctx.author.send(f'{key} is not set.')
         else:
-            config_ids = sorted(self.bot.config.keys())
-            max_length = int(self.bot.config.get('config:max_length', 10))
-            while len(config_ids) > max_length:
-                config_list = config_ids[:max_length]
-                config_ids[0:max_length] = []
-                await ctx.author.send(', '.join(config_list))
-            await ctx.author.send(', '.join(config_ids))
+            await self.send_ids(ctx, self.bot.config.keys_with_prefix(''))
+
+    async def send_ids(self, ctx: cmds.Context, config_ids):
+        max_length = self.bot.config.get_int('config:max_length', 10)
+        for i in range(0, len(config_ids), max_length):
+            await ctx.author.send(', '.join(config_ids[i:i + max_length]))
+
+    @cmds.command()
+    @cmds.is_owner()
+    async def configstats(self, ctx: cmds.Context):
+        """Show how often the configuration file has been written."""
+
+        stats = self.bot.config.stats()
+        pending = ' Changes are waiting to be written.' if stats['pending'] else ''
+        await ctx.author.send(f'{self.bot.config.path} has been written {stats["flushes"]} times, '
+                              f'{stats["bytes_written"]} bytes in total.{pending}')
 
     @cmds.command()
     @cmds.is_owner()
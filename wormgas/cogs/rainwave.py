@@ -9,7 +9,7 @@ import time
 import uuid
 
 from typing import Dict
-from wormgas.config import ConfigManager
+from wormgas.config import SqliteConfigManager
 from wormgas.util import to_bool
 from wormgas.wormgas import Wormgas
 
@@ -52,8 +52,8 @@ class RainwaveChannel(enum.Enum):
 class RainwaveCog(cmds.Cog):
     def __init__(self, bot: Wormgas):
         self.bot = bot
-        self.config_path = bot.config.path.with_name('_rainwave.json')
-        self.config = ConfigManager(self.config_path)
+        self.config_path = bot.config.path.with_name('_rainwave.sqlite')
+        self.config = SqliteConfigManager(self.config_path, import_path=bot.config.path.with_name('_rainwave.json'))
         self.nick_not_recognized = ('I do not recognize you. Use **!id add <id>** to link your Rainwave and Discord '
                                     'accounts.')
         self.missing_key = ('I do not have a key stored for you. Visit https://rainwave.cc/keys/ to get a key and tell '
@@ -64,6 +64,9 @@ class RainwaveCog(cmds.Cog):
         self.channel_codes = f'Channel codes are **{chan_code_ls}**.'
         self.topic_task = self.bot.loop.create_task(self.check_special_events())
 
+    def cog_unload(self):
+        self.config.close()
+
     async def _call(self, path: str, params: Dict = None):
         log.debug(f'_call {path} {params}')
         if params is None:
@@ -535,12 +538,12 @@ class RainwaveCog(cmds.Cog):
 
         if ctx.guild:
             config_id = f'rainwave:nx:{chan.channel_id}:{idx}'
-            if sched_id == self.bot.config.get(config_id, 0):
+            if sched_id == self.bot.state.get(config_id, 0):
                 c = f'You can only use **{cmd}** in {ctx.channel.mention} once per song.'
                 await ctx.author.send(c)
                 await ctx.author.send(m)
             else:
-                self.bot.config.set(config_id, sched_id)
+                self.bot.state.set(config_id, sched_id)
                 await ctx.send(m)
         else:
             await ctx.send(m)
@@ -608,13 +611,13 @@ class RainwaveCog(cmds.Cog):
             m += f': {self.song_string(song)}'
 
             if ctx.guild:
-                last = self.bot.config.get(f'rainwave:np:{chan.channel_id}', 0)
+                last = self.bot.state.get(f'rainwave:np:{chan.channel_id}', 0)
                 if sched_id == last:
                     c = f'You can only use **{cmd}** in {ctx.channel.mention} once per song.'
                     await ctx.author.send(c)
                     await ctx.author.send(m, embed=embed)
                 else:
-                    self.bot.config.set(f'rainwave:np:{chan.channel_id}', sched_id)
+                    self.bot.state.set(f'rainwave:np:{chan.channel_id}', sched_id)
                     await ctx.send(m, embed=embed)
             else:
                 await ctx.send(m, embed=embed)
@@ -703,11 +706,11 @@ class RainwaveCog(cmds.Cog):
 
             if ctx.guild:
                 last_sched_id = f'rainwave:pp:{chan.channel_id}:{idx}'
-                if sched_id == self.bot.config.get(last_sched_id, 0):
+                if sched_id == self.bot.state.get(last_sched_id, 0):
                     await ctx.author.send(f'You can only use {cmd} in {ctx.channel.mention} once per song.')
                     await ctx.author.send(m, embed=embed)
                 else:
-                    self.bot.config.set(last_sched_id, sched_id)
+                    self.bot.state.set(last_sched_id, sched_id)
                     await ctx.send(m, embed=embed)
             else:
                 await ctx.send(m, embed=embed)
@@ -830,11 +833,11 @@ class RainwaveCog(cmds.Cog):
                 return
 
             now = int(time.time())
-            last = int(self.bot.config.get('rainwave:ustats:last', 0))
-            wait = int(self.bot.config.get('rainwave:ustats:wait', 0))
+            last = self.bot.state.get_int('rainwave:ustats:last', 0)
+            wait = self.bot.config.get_int('rainwave:ustats:wait', 0)
             if last < now - wait:
                 await ctx.send(embed=embed)
-                self.bot.config.set('rainwave:ustats:last', now)
+                self.bot.state.set('rainwave:ustats:last', now)
             else:
                 await ctx.author.send(embed=embed)
                 remaining = last + wait - now
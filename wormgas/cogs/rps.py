@@ -2,7 +2,7 @@ import discord
 import discord.ext.commands as cmds
 import logging
 import random
-from wormgas.config import ConfigManager
+from wormgas.config import SqliteConfigManager
 from wormgas.wormgas import Wormgas
 
 log = logging.getLogger(__name__)
@@ -19,8 +19,11 @@ class RpsCog(cmds.Cog):
 
     def __init__(self, bot: Wormgas):
         self.bot = bot
-        self.config_path = bot.config.path.with_name('_rps.json')
-        self.config: ConfigManager = bot.config.__class__(self.config_path)
+        self.config_path = bot.config.path.with_name('_rps.sqlite')
+        self.config = SqliteConfigManager(self.config_path, import_path=bot.config.path.with_name('_rps.json'))
+
+    def cog_unload(self):
+        self.config.close()
 
     async def get_rps_record(self, player: discord.Member):
         player_id = str(player.id)
@@ -84,8 +87,7 @@ class RpsCog(cmds.Cog):
             global_dict['losses'] = global_dict.get('losses', 0) + 1
             m = m + ' You lose!'
 
-        self.config[challenger] = player_dict
-        self.config['!global'] = global_dict
+        self.config.update({challenger: player_dict, '!global': global_dict})
 
         w = player_dict.get('wins', 0)
         d = player_dict.get('draws', 0)
@@ -121,13 +123,17 @@ class RpsCog(cmds.Cog):
     @rps.command()
     async def reset(self, ctx: cmds.Context, reset_code: str = None):
         """Reset your record and delete your game history."""
-        player_dict = self.config.get(str(ctx.author.id))
-        if reset_code and reset_code == player_dict.get('reset_code'):
-            self.config.remove(str(ctx.author.id))
+        player_id = str(ctx.author.id)
+        player_dict = self.config.get(player_id)
+        if player_dict is None:
+            await ctx.author.send(f'You do not have an RPS record to reset.')
+        elif reset_code and reset_code == player_dict.get('reset_code'):
+            self.config.remove(player_id)
             await ctx.author.send(f'I reset your RPS record and deleted your game history.')
         else:
             reset_code = f'{random.randrange(999999):06d}'
             player_dict['reset_code'] = reset_code
+            self.config[player_id] = player_dict
             await ctx.author.send(f'Use !rps reset {reset_code} to reset your RPS record and delete your history.')
 
 
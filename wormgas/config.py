@@ -1,19 +1,57 @@
+import bisect
 import json
 import logging
+import os
 import pathlib
+import sqlite3
+import threading
+
+from typing import Optional
+from wormgas.util import to_bool
 
 log = logging.getLogger(__name__)
 
 
+def write_json(path: pathlib.Path, data: dict) -> int:
+    """Replace the file at path with data as JSON, atomically. Returns the number of bytes written."""
+    content = json.dumps(data, indent=2, sort_keys=True).encode()
+    tmp_path = path.with_name(f'{path.name}.tmp')
+    with tmp_path.open('wb') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    # readers see either the old file or the new one, never part of one
+    os.replace(tmp_path, path)
+    return len(content)
+
+
 class ConfigManager:
-    def __init__(self, path: pathlib.Path):
+    """A dict of settings that is saved to a JSON file whenever it changes.
+
+    With flush_ms, changes are saved by a background thread at most once every flush_ms milliseconds instead of on
+    every change. Call close() on shutdown to save the last changes. Without a path, settings are only kept in
+    memory."""
+
+    def __init__(self, path: Optional[pathlib.Path], flush_ms: int = 0):
         log.info(f'Initializing ConfigManager with path: {path}')
         self.path = path
+        self.flush_ms = flush_ms
+        self.flushes = 0
+        self.bytes_written = 0
         self.data = {}
-        if self.path.exists():
+        if self.path is not None and self.path.exists():
             with self.path.open() as f:
                 self.data = json.load(f)
 
+        # every key in order, for prefix lookups
+        self._sorted_keys = sorted(self.data)
+        # key -> {parser: parsed value}, for the typed getters
+        self._parsed = {}
+
+        self._dirty = threading.Event()
+        self._closing = threading.Event()
+        self._writer = None
+
     def __contains__(self, item):
         return item in self.data
 
@@ -22,24 +60,241 @@ class ConfigManager:
 
     def __setitem__(self, key, value):
         log.info(f'Setting {key!r} to {value!r}')
+        self._store(key, value)
+
+    def _store(self, key, value):
+        if key not in self.data:
+            bisect.insort(self._sorted_keys, key)
         self.data[key] = value
-        self._flush()
+        self._parsed.pop(key, None)
+        self._changed()
+
+    def _changed(self):
+        if self.path is None:
+            return
+        if not self.flush_ms:
+            self._flush()
+            return
+        self._dirty.set()
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_changes, name='config-writer', daemon=True)
+            self._writer.start()
+
+    def _write_changes(self):
+        while not self._closing.is_set():
+            self._dirty.wait()
+            # collect the changes made in the next flush_ms, or until close()
+            self._closing.wait(self.flush_ms / 1000)
+            self._dirty.clear()
+            try:
+                self._flush()
+            except OSError:
+                log.exception(f'Failed to write {self.path}')
 
     def _flush(self):
-        with self.path.open('w') as f:
-            json.dump(self.data, f, indent=2, sort_keys=True)
+        # A shallow copy can't change size while it is being written.
+        size = write_json(self.path, dict(self.data))
+        self.flushes += 1
+        self.bytes_written += size
+        log.debug(f'Wrote {size} bytes to {self.path} ({self.flushes} writes)')
+
+    def close(self):
+        """Stop the background writer and save any changes it has not written yet."""
+        if self._writer is not None:
+            self._closing.set()
+            self._dirty.set()
+            self._writer.join()
+            self._writer = None
+            self._closing.clear()
+            # changes made while the writer was writing its last copy
+            if self._dirty.is_set():
+                self._dirty.clear()
+                self._flush()
+
+    def stats(self):
+        return {'flushes': self.flushes, 'bytes_written': self.bytes_written, 'pending': self._dirty.is_set()}
 
     def get(self, key, default=None):
         return self.data.get(key, default)
 
+    def _get_parsed(self, key, parse, default):
+        parsed = self._parsed.get(key)
+        if parsed is not None and parse in parsed:
+            return parsed[parse]
+        value = self.data.get(key)
+        if value is None:
+            return default
+        result = parse(value)
+        self._parsed.setdefault(key, {})[parse] = result
+        return result
+
+    def get_int(self, key, default=None):
+        """Return the value of key as an int. The parsed value is cached until the key is set again."""
+        return self._get_parsed(key, int, default)
+
+    def get_float(self, key, default=None):
+        return self._get_parsed(key, float, default)
+
+    def get_bool(self, key, default=None):
+        return self._get_parsed(key, _parse_bool, default)
+
     def keys(self):
         return self.data.keys()
 
+    def keys_with_prefix(self, prefix: str):
+        """Return the keys that start with prefix, in order."""
+        start = bisect.bisect_left(self._sorted_keys, prefix)
+        end = start
+        while end < len(self._sorted_keys) and self._sorted_keys[end].startswith(prefix):
+            end += 1
+        return self._sorted_keys[start:end]
+
+    def ns(self, namespace: str):
+        """Return a view of the keys that start with namespace and a colon, e.g. ns('chat') for chat:*."""
+        return ConfigNamespace(self, namespace)
+
     def remove(self, key):
         log.info(f'Removing {key}')
         if key in self.data:
             del self.data[key]
-            self._flush()
+            del self._sorted_keys[bisect.bisect_left(self._sorted_keys, key)]
+            self._parsed.pop(key, None)
+            self._changed()
+
+    def set(self, key, value):
+        self[key] = value
+
+
+def _parse_bool(value):
+    # settings changed with !set are strings
+    return value if isinstance(value, bool) else to_bool(str(value))
+
+
+class ConfigNamespace:
+    """The keys of a ConfigManager under one prefix. ns = config.ns('chat') reads and writes chat:* keys, so
+    ns.get_int('wait_respond') reads chat:wait_respond."""
+
+    def __init__(self, config: ConfigManager, namespace: str):
+        self.config = config
+        self.prefix = f'{namespace}:'
+
+    def __contains__(self, item):
+        return self.prefix + item in self.config
+
+    def __getitem__(self, key):
+        return self.config[self.prefix + key]
+
+    def __setitem__(self, key, value):
+        self.config[self.prefix + key] = value
+
+    def get(self, key, default=None):
+        return self.config.get(self.prefix + key, default)
+
+    def get_int(self, key, default=None):
+        return self.config.get_int(self.prefix + key, default)
+
+    def get_float(self, key, default=None):
+        return self.config.get_float(self.prefix + key, default)
+
+    def get_bool(self, key, default=None):
+        return self.config.get_bool(self.prefix + key, default)
+
+    def keys(self):
+        """Return the keys in this namespace, without the prefix, in order."""
+        return [key[len(self.prefix):] for key in self.config.keys_with_prefix(self.prefix)]
+
+    def ns(self, namespace: str):
+        return ConfigNamespace(self.config, self.prefix + namespace)
+
+    def remove(self, key):
+        self.config.remove(self.prefix + key)
+
+    def set(self, key, value):
+        self[key] = value
+
+
+class SqliteConfigManager:
+    """A ConfigManager that keeps each setting in its own row of a SQLite table.
+
+    Use it for stores with a key for every user, where rewriting the whole file on every change would be slow. Setting
+    a key writes only that key's row. Values are stored as JSON. If the table is empty when it is opened and
+    import_path names an existing JSON file written by ConfigManager, that file is imported and then renamed with an
+    .imported suffix, so it is not imported again if the table is emptied later."""
+
+    def __init__(self, path: pathlib.Path, import_path: Optional[pathlib.Path] = None):
+        log.info(f'Initializing SqliteConfigManager with path: {path}')
+        self.path = path
+        self.flushes = 0
+        self.bytes_written = 0
+        self.conn = sqlite3.connect(str(path), isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=wal')
+        self.conn.execute('PRAGMA synchronous=normal')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT NOT NULL) '
+                          'WITHOUT ROWID')
+        if import_path is not None and import_path.exists() and not self.keys():
+            self.import_json(import_path)
+            imported_path = import_path.with_name(f'{import_path.name}.imported')
+            os.replace(import_path, imported_path)
+            log.info(f'Renamed {import_path} to {imported_path}')
+
+    def __contains__(self, item):
+        return self.conn.execute('SELECT 1 FROM config WHERE key = ?', (item,)).fetchone() is not None
+
+    def __getitem__(self, key):
+        row = self.conn.execute('SELECT value FROM config WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def __setitem__(self, key, value):
+        log.info(f'Setting {key!r} to {value!r}')
+        self._upsert([(key, value)])
+
+    def _upsert(self, items):
+        rows = [(key, json.dumps(value, sort_keys=True)) for key, value in items]
+        with self.conn:
+            self.conn.executemany('INSERT INTO config (key, value) VALUES (?, ?) '
+                                  'ON CONFLICT (key) DO UPDATE SET value = excluded.value', rows)
+        self.flushes += 1
+        self.bytes_written += sum(len(key) + len(value) for key, value in rows)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [key for key, in self.conn.execute('SELECT key FROM config ORDER BY key')]
+
+    def remove(self, key):
+        log.info(f'Removing {key}')
+        with self.conn:
+            self.conn.execute('DELETE FROM config WHERE key = ?', (key,))
 
     def set(self, key, value):
         self[key] = value
+
+    def update(self, items: dict):
+        """Set several keys in one transaction."""
+        log.info(f'Setting {items!r}')
+        self._upsert(items.items())
+
+    def import_json(self, path: pathlib.Path):
+        """Set every key in a JSON file written by ConfigManager, in one transaction."""
+        with path.open() as f:
+            data = json.load(f)
+        self._upsert(data.items())
+        log.info(f'Imported {len(data)} keys from {path} into {self.path}')
+
+    def export_json(self, path: pathlib.Path):
+        """Write every key to a JSON file that ConfigManager can read."""
+        data = {key: json.loads(value) for key, value in self.conn.execute('SELECT key, value FROM config')}
+        write_json(path, data)
+        log.info(f'Exported {len(data)} keys from {self.path} to {path}')
+
+    def close(self):
+        self.conn.close()
+
+    def stats(self):
+        return {'flushes': self.flushes, 'bytes_written': self.bytes_written, 'pending': False}
@@ -0,0 +1,40 @@
+import logging
+import pathlib
+
+from typing import Optional
+from wormgas.config import ConfigManager
+
+log = logging.getLogger(__name__)
+
+# Keys that change with chat and commands, such as cooldown timestamps. These belong in the state store, not in the
+# configuration file.
+VOLATILE_PREFIXES = (
+    'chat:last_time_respond:',
+    'chat:last_time_public_message:',
+    'chat:last_message',
+    'rainwave:np:',
+    'rainwave:nx:',
+    'rainwave:pp:',
+    'rainwave:ustats:last',
+)
+
+
+class StateStore(ConfigManager):
+    """Runtime state, such as cooldown timestamps, kept in memory.
+
+    With a path, the state is loaded from that file at startup and snapshotted to it at most once every snapshot_ms
+    milliseconds, so it survives restarts. Without one, it is lost on restart."""
+
+    def __init__(self, path: Optional[pathlib.Path] = None, snapshot_ms: int = 60000):
+        super().__init__(path, flush_ms=snapshot_ms)
+
+    def __setitem__(self, key, value):
+        log.debug(f'Setting {key!r} to {value!r}')
+        self._store(key, value)
+
+    def adopt(self, config: ConfigManager):
+        """Move the volatile keys left in a configuration file by older versions into this store."""
+        for key in [key for key in config.keys() if key.startswith(VOLATILE_PREFIXES)]:
+            if key not in self:
+                self[key] = config[key]
+            config.remove(key)
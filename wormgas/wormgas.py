@@ -6,15 +6,27 @@ import pathlib
 import sys
 
 from wormgas.config import ConfigManager
+from wormgas.state import StateStore
 
 
 class Wormgas(cmds.Bot):
 
-    def __init__(self, config_path: pathlib.Path, command_prefix, **options):
+    def __init__(self, config_path: pathlib.Path, command_prefix, config_flush_ms: int = 0, **options):
         super().__init__(command_prefix, **options)
-        self.config = ConfigManager(config_path)
+        self.config = ConfigManager(config_path, flush_ms=config_flush_ms)
+        # Cooldowns and other state that changes with every message, snapshotted every state:snapshot_ms milliseconds.
+        # 0 keeps it in memory only.
+        snapshot_ms = int(self.config.get('state:snapshot_ms', 60000))
+        state_path = config_path.with_name('_state.json') if snapshot_ms else None
+        self.state = StateStore(state_path, snapshot_ms=snapshot_ms)
+        self.state.adopt(self.config)
         self.session = aiohttp.ClientSession(loop=self.loop, timeout=(aiohttp.ClientTimeout(total=10)))
 
+    async def close(self):
+        await super().close()
+        self.state.close()
+        self.config.close()
+
 
 def version():
     return os.getenv('APP_VERSION', 'unknown')
@@ -30,7 +42,10 @@ def main():
     for logger in ('discord.client', 'discord.gateway', 'websockets.protocol'):
         logging.getLogger(logger).setLevel(logging.INFO)
     config_file = os.getenv('CONFIG_FILE', '/opt/wormgas/_config.json')
-    bot = Wormgas(config_path=pathlib.Path(config_file).resolve(), command_prefix='!', pm_help=True)
+    # Save configuration changes at most once a second.
+    config_flush_ms = int(os.getenv('CONFIG_FLUSH_MS', 1000))
+    bot = Wormgas(config_path=pathlib.Path(config_file).resolve(), command_prefix='!', pm_help=True,
+                  config_flush_ms=config_flush_ms)
     bot.load_extension('wormgas.cogs.chat')
     bot.load_extension('wormgas.cogs.config')
     bot.load_extension('wormgas.cogs.rainwave')
@@ -41,6 +56,8 @@ def main():
     token = bot.config.get('discord:token')
     if token in (None, 'TOKEN'):
         bot.config.set('discord:token', 'TOKEN')
+        bot.state.close()
+        bot.config.close()
         logging.critical(f'Before you can run for the first time, edit {config_file} and set discord:token')
     else:
         bot.run(bot.config.get('discord:token'))